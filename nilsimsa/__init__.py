@@ -10,15 +10,30 @@ and the references (particularly Damiani et al.)
 
 Implementation details:
 Nilsimsa class takes in a data paramater that can be an iterator over chunks of text or a text string.
+Bytes-like data (bytearray, memoryview, mmap, numpy arrays, ...) is hashed in place, without copying.
 Calling the methods hexdigest() and digest() give the nilsimsa
 digest of the input data.
+The optional backend paramater selects how the input is hashed: 'python'
+is the reference implementation, 'table' is a faster pure Python loop over
+precomputed lookup tables, and 'numpy' computes the trigrams of whole
+chunks with NumPy arrays and requires numpy to be installed.  The default,
+'auto', uses numpy for large chunks when it is installed and the table
+loop otherwise; the NILSIMSA_BACKEND environment variable overrides it.
+Backends are modules imported on first use, see BACKENDS and
+register_backend().  All of them give identical digests.
 The helper function compare_digests takes in two digests and computes the Nilsimsa score.
+NilsimsaDigest is a compact immutable digest value, returned by
+Nilsimsa.compact_digest(), that compare_digests and Nilsimsa.compare
+accept directly.
 
 This software is released under an MIT/X11 open source license.
 
 Copyright 2012-2014 Diffeo, Inc.
 """
 
+import binascii
+import heapq
+import os
 import sys
 
 if sys.version_info[0] >= 3:
@@ -30,49 +45,157 @@ else:
     text_type = unicode
     range_ = xrange
 
+if hasattr(int, 'bit_count'):
+    popcount = int.bit_count
+else:
+    def popcount(x):
+        """number of 1's in the binary representation of x"""
+        return bin(x).count('1')
+
 def is_iterable_non_string(obj):
     return hasattr(obj, '__iter__') and not isinstance(obj, (bytes, text_type))
 
+def supports_buffer(obj):
+    """returns whether obj supports the buffer protocol, e.g. bytearray"""
+    try:
+        memoryview(obj)
+    except TypeError:
+        return False
+    return True
+
+def byte_view(obj):
+    """
+    returns the raw bytes of obj, which supports the buffer protocol, as a
+    flat memoryview of unsigned bytes; only non-contiguous buffers are copied
+    """
+    view = memoryview(obj)
+    if not view.c_contiguous:
+        return memoryview(view.tobytes())
+    if view.format != 'B' or view.ndim != 1:
+        return view.cast('B')
+    return view
+
 # Constant used in tran53 hash function, contains values 0 <= x <= 255
 # see implementation of tran_hash() below for details on usage
-TRAN = [ord(x) for x in
-    "\x02\xD6\x9E\x6F\xF9\x1D\x04\xAB\xD0\x22\x16\x1F\xD8\x73\xA1\xAC"\
-    "\x3B\x70\x62\x96\x1E\x6E\x8F\x39\x9D\x05\x14\x4A\xA6\xBE\xAE\x0E"\
-    "\xCF\xB9\x9C\x9A\xC7\x68\x13\xE1\x2D\xA4\xEB\x51\x8D\x64\x6B\x50"\
-    "\x23\x80\x03\x41\xEC\xBB\x71\xCC\x7A\x86\x7F\x98\xF2\x36\x5E\xEE"\
-    "\x8E\xCE\x4F\xB8\x32\xB6\x5F\x59\xDC\x1B\x31\x4C\x7B\xF0\x63\x01"\
-    "\x6C\xBA\x07\xE8\x12\x77\x49\x3C\xDA\x46\xFE\x2F\x79\x1C\x9B\x30"\
-    "\xE3\x00\x06\x7E\x2E\x0F\x38\x33\x21\xAD\xA5\x54\xCA\xA7\x29\xFC"\
-    "\x5A\x47\x69\x7D\xC5\x95\xB5\xF4\x0B\x90\xA3\x81\x6D\x25\x55\x35"\
-    "\xF5\x75\x74\x0A\x26\xBF\x19\x5C\x1A\xC6\xFF\x99\x5D\x84\xAA\x66"\
-    "\x3E\xAF\x78\xB3\x20\x43\xC1\xED\x24\xEA\xE6\x3F\x18\xF3\xA0\x42"\
-    "\x57\x08\x53\x60\xC3\xC0\x83\x40\x82\xD7\x09\xBD\x44\x2A\x67\xA8"\
-    "\x93\xE0\xC2\x56\x9F\xD9\xDD\x85\x15\xB4\x8A\x27\x28\x92\x76\xDE"\
-    "\xEF\xF8\xB2\xB7\xC9\x3D\x45\x94\x4B\x11\x0D\x65\xD5\x34\x8B\x91"\
-    "\x0C\xFA\x87\xE9\x7C\x5B\xB1\x4D\xE5\xD4\xCB\x10\xA2\x17\x89\xBC"\
-    "\xDB\xB0\xE2\x97\x88\x52\xF7\x48\xD3\x61\x2C\x3A\x2B\xD1\x8C\xFB"\
-    "\xF1\xCD\xE4\x6A\xE7\xA9\xFD\xC4\x37\xC8\xD2\xF6\xDF\x58\x72\x4E"]
+TRAN = list(bytearray(
+    b"\x02\xD6\x9E\x6F\xF9\x1D\x04\xAB\xD0\x22\x16\x1F\xD8\x73\xA1\xAC"\
+    b"\x3B\x70\x62\x96\x1E\x6E\x8F\x39\x9D\x05\x14\x4A\xA6\xBE\xAE\x0E"\
+    b"\xCF\xB9\x9C\x9A\xC7\x68\x13\xE1\x2D\xA4\xEB\x51\x8D\x64\x6B\x50"\
+    b"\x23\x80\x03\x41\xEC\xBB\x71\xCC\x7A\x86\x7F\x98\xF2\x36\x5E\xEE"\
+    b"\x8E\xCE\x4F\xB8\x32\xB6\x5F\x59\xDC\x1B\x31\x4C\x7B\xF0\x63\x01"\
+    b"\x6C\xBA\x07\xE8\x12\x77\x49\x3C\xDA\x46\xFE\x2F\x79\x1C\x9B\x30"\
+    b"\xE3\x00\x06\x7E\x2E\x0F\x38\x33\x21\xAD\xA5\x54\xCA\xA7\x29\xFC"\
+    b"\x5A\x47\x69\x7D\xC5\x95\xB5\xF4\x0B\x90\xA3\x81\x6D\x25\x55\x35"\
+    b"\xF5\x75\x74\x0A\x26\xBF\x19\x5C\x1A\xC6\xFF\x99\x5D\x84\xAA\x66"\
+    b"\x3E\xAF\x78\xB3\x20\x43\xC1\xED\x24\xEA\xE6\x3F\x18\xF3\xA0\x42"\
+    b"\x57\x08\x53\x60\xC3\xC0\x83\x40\x82\xD7\x09\xBD\x44\x2A\x67\xA8"\
+    b"\x93\xE0\xC2\x56\x9F\xD9\xDD\x85\x15\xB4\x8A\x27\x28\x92\x76\xDE"\
+    b"\xEF\xF8\xB2\xB7\xC9\x3D\x45\x94\x4B\x11\x0D\x65\xD5\x34\x8B\x91"\
+    b"\x0C\xFA\x87\xE9\x7C\x5B\xB1\x4D\xE5\xD4\xCB\x10\xA2\x17\x89\xBC"\
+    b"\xDB\xB0\xE2\x97\x88\x52\xF7\x48\xD3\x61\x2C\x3A\x2B\xD1\x8C\xFB"\
+    b"\xF1\xCD\xE4\x6A\xE7\xA9\xFD\xC4\x37\xC8\xD2\xF6\xDF\x58\x72\x4E"))
+
+# (a, b, c, n) for each of the eight tran_hash(a, b, c, n) trigrams that
+# process() computes per character, with a, b and c given as offsets back
+# from the current character: 0 is the current character, 1 is window[0],
+# ..., 4 is window[3].  A trigram is only formed once all the characters
+# it refers to have been seen.
+TRIGRAMS = [
+    (0, 1, 2, 0),
+    (0, 1, 3, 1),
+    (0, 2, 3, 2),
+    (0, 1, 4, 3),
+    (0, 2, 4, 4),
+    (0, 3, 4, 5),
+    (4, 1, 0, 6),
+    (4, 3, 0, 7),
+]
+
+# Size of the reads used by Nilsimsa.from_file and from_stream
+CHUNK_SIZE = 1 << 16
+
+# Collector of hot path metrics, None unless enabled, see nilsimsa.metrics
+_metrics = None
+
+# Registry of backends accepted by the backend paramater of Nilsimsa and
+# compare_digests: name -> module implementing it, imported on first use.
+# A backend module defines process(nilsimsa, chunk), which adds the
+# trigrams of the byte string chunk to nilsimsa.acc and advances
+# nilsimsa.window and nilsimsa.num_char, and may define
+# compare_digests(digest_1, digest_2, is_hex_1, is_hex_2, threshold).
+# 'python' is the reference implementation in this module.  'auto' picks
+# the fastest available backend for each chunk.
+BACKENDS = {
+    'auto': 'nilsimsa._auto_backend',
+    'python': None,
+    'table': 'nilsimsa._table_backend',
+    'numpy': 'nilsimsa._numpy_backend',
+}
+
+# Environment variable overriding the default backend, 'auto'
+BACKEND_ENV = 'NILSIMSA_BACKEND'
+
+_backend_modules = {}
+
+def register_backend(name, module_name):
+    """
+    registers the backend implemented by the module named `module_name`
+    under `name`; the module is only imported when the backend is used
+    """
+    BACKENDS[name] = module_name
+    _backend_modules.pop(name, None)
+
+def get_backend(name):
+    """
+    returns the module implementing backend `name`, importing it on first
+    use, or None for the reference 'python' backend; raises ImportError if
+    its dependencies are missing
+    """
+    if name not in BACKENDS:
+        raise ValueError("Expected backend in {}, got {!r}"
+                            .format(sorted(BACKENDS), name))
+    module = _backend_modules.get(name)
+    if module is None and BACKENDS[name] is not None:
+        import importlib
+        module = _backend_modules[name] = importlib.import_module(BACKENDS[name])
+    return module
+
+def available_backends():
+    """returns the sorted names of the backends that can be imported here"""
+    names = []
+    for name in BACKENDS:
+        try:
+            get_backend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return sorted(names)
+
+def default_backend():
+    """returns the backend used when none is given, 'auto' unless overridden
+    by the NILSIMSA_BACKEND environment variable"""
+    return os.environ.get(BACKEND_ENV) or 'auto'
 
 # Shortcut to compute the Hamming distance between two bit vector representations of integers
 # POPC - population count, POPC[x] = number of 1's in binary representation of x
 # POPC[a ^b] = hamming distance from a to b
-POPC = [ord(x) for x in
-    "\x00\x01\x01\x02\x01\x02\x02\x03\x01\x02\x02\x03\x02\x03\x03\x04"\
-    "\x01\x02\x02\x03\x02\x03\x03\x04\x02\x03\x03\x04\x03\x04\x04\x05"\
-    "\x01\x02\x02\x03\x02\x03\x03\x04\x02\x03\x03\x04\x03\x04\x04\x05"\
-    "\x02\x03\x03\x04\x03\x04\x04\x05\x03\x04\x04\x05\x04\x05\x05\x06"\
-    "\x01\x02\x02\x03\x02\x03\x03\x04\x02\x03\x03\x04\x03\x04\x04\x05"\
-    "\x02\x03\x03\x04\x03\x04\x04\x05\x03\x04\x04\x05\x04\x05\x05\x06"\
-    "\x02\x03\x03\x04\x03\x04\x04\x05\x03\x04\x04\x05\x04\x05\x05\x06"\
-    "\x03\x04\x04\x05\x04\x05\x05\x06\x04\x05\x05\x06\x05\x06\x06\x07"\
-    "\x01\x02\x02\x03\x02\x03\x03\x04\x02\x03\x03\x04\x03\x04\x04\x05"\
-    "\x02\x03\x03\x04\x03\x04\x04\x05\x03\x04\x04\x05\x04\x05\x05\x06"\
-    "\x02\x03\x03\x04\x03\x04\x04\x05\x03\x04\x04\x05\x04\x05\x05\x06"\
-    "\x03\x04\x04\x05\x04\x05\x05\x06\x04\x05\x05\x06\x05\x06\x06\x07"\
-    "\x02\x03\x03\x04\x03\x04\x04\x05\x03\x04\x04\x05\x04\x05\x05\x06"\
-    "\x03\x04\x04\x05\x04\x05\x05\x06\x04\x05\x05\x06\x05\x06\x06\x07"\
-    "\x03\x04\x04\x05\x04\x05\x05\x06\x04\x05\x05\x06\x05\x06\x06\x07"\
-    "\x04\x05\x05\x06\x05\x06\x06\x07\x05\x06\x06\x07\x06\x07\x07\x08"]
+POPC = list(bytearray(
+    b"\x00\x01\x01\x02\x01\x02\x02\x03\x01\x02\x02\x03\x02\x03\x03\x04"\
+    b"\x01\x02\x02\x03\x02\x03\x03\x04\x02\x03\x03\x04\x03\x04\x04\x05"\
+    b"\x01\x02\x02\x03\x02\x03\x03\x04\x02\x03\x03\x04\x03\x04\x04\x05"\
+    b"\x02\x03\x03\x04\x03\x04\x04\x05\x03\x04\x04\x05\x04\x05\x05\x06"\
+    b"\x01\x02\x02\x03\x02\x03\x03\x04\x02\x03\x03\x04\x03\x04\x04\x05"\
+    b"\x02\x03\x03\x04\x03\x04\x04\x05\x03\x04\x04\x05\x04\x05\x05\x06"\
+    b"\x02\x03\x03\x04\x03\x04\x04\x05\x03\x04\x04\x05\x04\x05\x05\x06"\
+    b"\x03\x04\x04\x05\x04\x05\x05\x06\x04\x05\x05\x06\x05\x06\x06\x07"\
+    b"\x01\x02\x02\x03\x02\x03\x03\x04\x02\x03\x03\x04\x03\x04\x04\x05"\
+    b"\x02\x03\x03\x04\x03\x04\x04\x05\x03\x04\x04\x05\x04\x05\x05\x06"\
+    b"\x02\x03\x03\x04\x03\x04\x04\x05\x03\x04\x04\x05\x04\x05\x05\x06"\
+    b"\x03\x04\x04\x05\x04\x05\x05\x06\x04\x05\x05\x06\x05\x06\x06\x07"\
+    b"\x02\x03\x03\x04\x03\x04\x04\x05\x03\x04\x04\x05\x04\x05\x05\x06"\
+    b"\x03\x04\x04\x05\x04\x05\x05\x06\x04\x05\x05\x06\x05\x06\x06\x07"\
+    b"\x03\x04\x04\x05\x04\x05\x05\x06\x04\x05\x05\x06\x05\x06\x06\x07"\
+    b"\x04\x05\x05\x06\x05\x06\x06\x07\x05\x06\x06\x07\x06\x07\x07\x08"))
 
 
 class Nilsimsa(object):
@@ -80,20 +203,29 @@ class Nilsimsa(object):
     computes the nilsimsa has of an input data block, which can be an
     iterator over chunks, with each chunk corresponding to a block of text
     """
-    def __init__(self, data = None):
+    def __init__(self, data = None, backend = None):
         # data comes as an iterator over chunks, which are an iterator over characters
+        if backend is None:
+            backend = default_backend()
+        # checks the name and imports the backend now rather than mid-stream
+        get_backend(backend)
+        self.backend = backend
         self._digest = None
         self.num_char = 0           # Number of characters that we have come across
         self.acc = [0] * 256        # 256-bit vector to hold the results of the digest
         self.window = []            # holds the window of the last 4 characters
-        if data:
-            if is_iterable_non_string(data):
+        self.head = []              # holds the first 4 characters, used by merge()
+        if data is not None:
+            if isinstance(data, (bytes, text_type)):
+                if data:
+                    self.process(data)
+            elif supports_buffer(data):
+                self.process(data)
+            elif is_iterable_non_string(data):
                 for chunk in data:
                     self.process(chunk)
-            elif isinstance(data, (bytes, text_type)):
-                self.process(data)
             else:
-                raise TypeError("Excpected string, iterable or None, got {}"
+                raise TypeError("Excpected string, buffer, iterable or None, got {}"
                                     .format(type(data)))
 
     def tran_hash(self, a, b, c, n):
@@ -104,12 +236,37 @@ class Nilsimsa(object):
         """
         computes the hash of all of the trigrams in the chunk using a window
         of length 5
+
+        The chunk is a str, encoded as UTF-8, or bytes or any other object
+        supporting the buffer protocol (bytearray, memoryview, mmap, numpy
+        array, ...), whose raw bytes are hashed in place without copying.
         """
         self._digest = None
 
-        if isinstance(chunk, text_type):
+        if isinstance(chunk, bytes):
+            pass
+        elif isinstance(chunk, text_type):
             chunk = chunk.encode('utf-8')
+        else:
+            chunk = byte_view(chunk)
+
+        if self.num_char < 4:
+            self.head = self.head + list(bytearray(chunk[:4 - self.num_char]))
+
+        if _metrics is not None:
+            start = _metrics.clock()
+
+        backend = get_backend(self.backend)
+        if backend is None:
+            self._process_python(chunk)
+        else:
+            backend.process(self, chunk)
 
+        if _metrics is not None:
+            _metrics.record_process(len(chunk), _metrics.clock() - start)
+
+    def _process_python(self, chunk):
+        """reference implementation of process() for a byte string"""
         # chunk is a byte string
         for char in chunk:
             self.num_char += 1
@@ -137,11 +294,41 @@ class Nilsimsa(object):
             else:
                 self.window = [c] + self.window[:3]
 
+    def merge(self, other):
+        """
+        adds the state of `other`, a Nilsimsa object that was fed the data
+        immediately following the data fed to this one, so that the result
+        is the same as feeding all of it to this object; returns self
+
+        The accumulator is additive, so only the trigrams spanning the
+        boundary need fixing up: those formed by the first characters of
+        `other` together with the last characters of this object.
+        """
+        # _process_python rather than process(), so the boundary bytes,
+        # already counted when they were hashed, are not recorded again
+        # by metrics
+        head = bytes(bytearray(other.head))
+        with_context = Nilsimsa(backend='python')
+        with_context.window = list(self.window)
+        with_context._process_python(head)
+        without_context = Nilsimsa(backend='python')
+        without_context._process_python(head)
+        for i in range(256):
+            self.acc[i] += (other.acc[i] + with_context.acc[i]
+                            - without_context.acc[i])
+        if self.num_char < 4:
+            self.head = (self.head + other.head)[:4]
+        self.window = (other.window + self.window)[:4]
+        self.num_char += other.num_char
+        self._digest = None
+        return self
 
     def compute_digest(self):
         """
         using a threshold (mean of the accumulator), computes the nilsimsa digest
         """
+        if _metrics is not None:
+            start = _metrics.clock()
         num_trigrams = 0
         if self.num_char == 3:          # 3 chars -> 1 trigram
             num_trigrams = 1
@@ -160,6 +347,9 @@ class Nilsimsa(object):
 
         self._digest = digest[::-1]      # store result in digest, reversed
 
+        if _metrics is not None:
+            _metrics.record_digest(_metrics.clock() - start)
+
     @property
     def digest(self):
         """
@@ -179,18 +369,57 @@ class Nilsimsa(object):
         """convenience function"""
         return self.hexdigest()
 
-    def from_file(self, fname):
-        """read in a file and compute digest"""
+    def compact_digest(self):
+        """
+        returns the digest as an immutable NilsimsaDigest
+        """
+        return NilsimsaDigest.from_ints(self.digest)
+
+    def from_file(self, fname, chunk_size=CHUNK_SIZE, use_mmap=False):
+        """
+        read in a file chunk_size bytes at a time and compute digest,
+        so memory use does not depend on the size of the file; with
+        use_mmap the file is mapped and hashed in slices of the map
+        """
         f = open(fname, "rb")
-        data = f.read()
-        self.update(data)
-        f.close()
+        try:
+            if use_mmap and os.fstat(f.fileno()).st_size > 0:
+                import mmap
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                view = memoryview(data)
+                try:
+                    for start in range(0, len(view), chunk_size):
+                        self.process(view[start:start + chunk_size])
+                finally:
+                    # the map cannot be closed while a view exports it
+                    view.release()
+                    data.close()
+            else:
+                self.from_stream(f, chunk_size)
+        finally:
+            f.close()
+        return self
+
+    def from_stream(self, stream, chunk_size=CHUNK_SIZE):
+        """
+        read a file-like object chunk_size bytes (or characters, for
+        text streams) at a time and compute digest
+        """
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            self.process(chunk)
+        return self
 
     def compare(self, digest_2, is_hex = False):
         """
         returns difference between the nilsimsa digests between the current
         object and a given digest
         """
+        if isinstance(digest_2, NilsimsaDigest):
+            return self.compact_digest().compare(digest_2)
+
         # convert hex string to list of ints
         if is_hex:
             digest_2 = convert_hex_to_ints(digest_2)
@@ -202,10 +431,114 @@ class Nilsimsa(object):
         return 128 - bit_diff       # -128 <= nilsimsa score <= 128
 
 
+class NilsimsaDigest(object):
+    """
+    compact immutable nilsimsa digest, stored as a single 256-bit int
+    whose big-endian bytes are the 32 bytes of Nilsimsa.digest
+
+    Hashable and picklable; comparisons popcount the xor of two ints
+    instead of walking the digest byte by byte.
+    """
+    __slots__ = ('_value',)
+
+    def __init__(self, value):
+        if not 0 <= value < 1 << 256:
+            raise ValueError("Expected a 256-bit unsigned int, got {!r}"
+                                .format(value))
+        object.__setattr__(self, '_value', value)
+
+    @classmethod
+    def from_hex(cls, hexdigest):
+        """builds a digest from a 64 character hex string"""
+        if len(hexdigest) != 64:
+            raise ValueError("Expected 64 hex characters, got {}"
+                                .format(len(hexdigest)))
+        return cls(int(hexdigest, 16))
+
+    @classmethod
+    def from_bytes(cls, data):
+        """builds a digest from 32 raw bytes"""
+        if len(data) != 32:
+            raise ValueError("Expected 32 bytes, got {}".format(len(data)))
+        return cls(int(binascii.hexlify(data), 16))
+
+    @classmethod
+    def from_ints(cls, digest):
+        """builds a digest from a list of 32 ints, as Nilsimsa.digest"""
+        return cls.from_bytes(bytes(bytearray(digest)))
+
+    def hexdigest(self):
+        """returns the digest as a 64 character hex string"""
+        return '%064x' % self._value
+
+    def to_bytes(self):
+        """returns the digest as 32 raw bytes"""
+        return binascii.unhexlify(self.hexdigest())
+
+    def to_ints(self):
+        """returns the digest as a list of 32 ints, as Nilsimsa.digest"""
+        return list(bytearray(self.to_bytes()))
+
+    def bit_difference(self, other):
+        """number of bits that differ between this digest and `other`"""
+        return popcount(self._value ^ other._value)
+
+    def compare(self, other, threshold=None):
+        """
+        returns the nilsimsa score between this digest and `other`,
+        -128 <= score <= 128; with `threshold` set, scores below it are
+        reported as `threshold - 1`, as in compare_digests
+        """
+        score = 128 - popcount(self._value ^ other._value)
+        if threshold is not None and score < threshold:
+            return threshold - 1
+        return score
+
+    def __int__(self):
+        return self._value
+
+    def __eq__(self, other):
+        if not isinstance(other, NilsimsaDigest):
+            return NotImplemented
+        return self._value == other._value
+
+    def __ne__(self, other):
+        if not isinstance(other, NilsimsaDigest):
+            return NotImplemented
+        return self._value != other._value
+
+    def __hash__(self):
+        return hash(self._value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("NilsimsaDigest is immutable")
+
+    def __reduce__(self):
+        return (NilsimsaDigest, (self._value,))
+
+    def __repr__(self):
+        return 'NilsimsaDigest(%r)' % self.hexdigest()
+
+    def __str__(self):
+        return self.hexdigest()
+
+
 def convert_hex_to_ints(hexdigest):
     return [int(hexdigest[i:i+2], 16) for i in range(0, 63, 2)]
 
-def compare_digests(digest_1, digest_2, is_hex_1=True, is_hex_2=True, threshold=None):
+def as_nilsimsa_digest(digest, is_hex=True):
+    """
+    returns `digest` as a NilsimsaDigest; takes param for format, default
+    is hex string but can accept list of 32 ints
+    """
+    if isinstance(digest, NilsimsaDigest):
+        return digest
+    if is_hex:
+        return NilsimsaDigest.from_hex(digest)
+    return NilsimsaDigest.from_ints(digest)
+
+def compare_digests(digest_1, digest_2, is_hex_1=True, is_hex_2=True, threshold=None,
+                    backend=None):
     """
     computes bit difference between two nilsisa digests
     takes params for format, default is hex string but can accept list
@@ -218,7 +551,40 @@ def compare_digests(digest_1, digest_2, is_hex_1=True, is_hex_2=True, threshold=
     comparisons of very different items; e.g. tests show a ~20-30% speed
     up.  `threshold` must be an integer in the range [-128, 128].
 
+    Either digest may also be a NilsimsaDigest, in which case its is_hex
+    flag is ignored and the comparison is a single popcount with no
+    parsing; scores below `threshold` are then reported as exactly
+    `threshold - 1`.
+
+    `backend` names a registered backend whose compare_digests is used
+    instead of the reference loops below, if it defines one; see
+    BACKENDS.  It defaults to default_backend(), as for Nilsimsa.  The
+    'auto' backend compares with a single popcount and, like a
+    NilsimsaDigest, reports every score below `threshold` as exactly
+    `threshold - 1`, whereas the early exit of the reference loops
+    ('python', 'table' and 'numpy') can return lower values.
+
     """
+    if _metrics is not None:
+        start = _metrics.clock()
+    if backend is None:
+        backend = default_backend()
+    module = get_backend(backend)
+    compare = getattr(module, 'compare_digests', None)
+    if compare is not None:
+        score = compare(digest_1, digest_2, is_hex_1, is_hex_2, threshold)
+        if _metrics is not None:
+            _metrics.record_compare(threshold is not None and score < threshold,
+                                    _metrics.clock() - start)
+        return score
+    if isinstance(digest_1, NilsimsaDigest) or isinstance(digest_2, NilsimsaDigest):
+        digest_1 = as_nilsimsa_digest(digest_1, is_hex_1)
+        digest_2 = as_nilsimsa_digest(digest_2, is_hex_2)
+        score = digest_1.compare(digest_2, threshold)
+        if _metrics is not None:
+            _metrics.record_compare(threshold is not None and score < threshold,
+                                    _metrics.clock() - start)
+        return score
     # if we have both hexes use optimized method
     if threshold is not None:
         threshold -= 128
@@ -228,14 +594,51 @@ def compare_digests(digest_1, digest_2, is_hex_1=True, is_hex_2=True, threshold=
         for i in range_(0, 63, 2):
             bits += POPC[255 & int(digest_1[i:i+2], 16) ^ int(digest_2[i:i+2], 16)]
             if threshold is not None and bits > threshold: break
-        return 128 - bits
     else:
         # at least one of the inputs is a list of unsigned ints
         if is_hex_1:  digest_1 = convert_hex_to_ints(digest_1)
         if is_hex_2:  digest_2 = convert_hex_to_ints(digest_2)
-        bit_diff = 0
+        bits = 0
         for i in range(len(digest_1)):
-            bit_diff += POPC[255 & digest_1[i] ^ digest_2[i]]
-            if threshold is not None and bit_diff > threshold: break
-        return 128 - bit_diff
+            bits += POPC[255 & digest_1[i] ^ digest_2[i]]
+            if threshold is not None and bits > threshold: break
+    if _metrics is not None:
+        _metrics.record_compare(threshold is not None and bits > threshold,
+                                _metrics.clock() - start)
+    return 128 - bits
 
+def top_k(digest, digests, k, is_hex=True):
+    """
+    returns a list of (index, score) for the `k` digests in `digests` with
+    the highest nilsimsa score against `digest`, highest score first and
+    lowest index first among equal scores
+
+    `digests` is a sequence of digests, hex strings by default or lists
+    of 32 ints if `is_hex` is False; NilsimsaDigests are accepted either
+    way.  They are scored with compare_digests, whose threshold is raised
+    to just above the k-th best score seen so far, so most comparisons
+    against a large corpus bail out early.  A packed digest matrix or
+    buffer, or a DigestStore, is instead scored with
+    nilsimsa.batch.top_k, which requires numpy.
+    """
+    if hasattr(digests, 'digests') or supports_buffer(digests):
+        from nilsimsa.batch import top_k as batch_top_k
+        packed = getattr(digests, 'digests', digests)
+        return batch_top_k(digest, packed, k, is_hex=is_hex)
+    if k <= 0:
+        return []
+    # best is a heap of (score, -index), so best[0] is the worst of the k
+    # best so far; a later digest must score strictly higher to replace it
+    best = []
+    threshold = None
+    for index, other in enumerate(digests):
+        score = compare_digests(digest, other, is_hex, is_hex, threshold)
+        if len(best) < k:
+            heapq.heappush(best, (score, -index))
+            if len(best) == k:
+                threshold = min(128, best[0][0] + 1)
+        elif score > best[0][0]:
+            heapq.heapreplace(best, (score, -index))
+            threshold = min(128, best[0][0] + 1)
+    best.sort(reverse=True)
+    return [(-index, score) for score, index in best]
@@ -0,0 +1,62 @@
+"""
+Purpose: the default 'auto' nilsimsa backend, which picks the fastest
+available implementation for each chunk.
+
+NumPy has a fixed cost per call of a few tens of microseconds, so it only
+pays off on chunks of at least NUMPY_MIN_CHUNK bytes; smaller chunks, and
+every chunk when numpy is not installed, go to the table backend.  numpy
+is imported the first time a large chunk is seen, so hashing short
+strings never pays for importing it.  All backends give identical
+digests, so the choice can change from chunk to chunk.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+"""
+from __future__ import absolute_import
+
+from nilsimsa import as_nilsimsa_digest
+from nilsimsa import _table_backend
+
+# chunks at least this long are hashed with numpy, when it is installed
+NUMPY_MIN_CHUNK = 128
+
+# the numpy backend module, False until it has been tried and None if it
+# could not be imported
+_numpy_backend = False
+
+
+def _load_numpy_backend():
+    global _numpy_backend
+    try:
+        from nilsimsa import _numpy_backend as backend
+    except ImportError:
+        backend = None
+    _numpy_backend = backend
+    return backend
+
+
+def process(nilsimsa, chunk):
+    """
+    adds the trigrams of the byte string `chunk` to the accumulator of
+    the Nilsimsa object `nilsimsa` and advances its window
+    """
+    if len(chunk) >= NUMPY_MIN_CHUNK:
+        backend = _numpy_backend
+        if backend is False:
+            backend = _load_numpy_backend()
+        if backend is not None:
+            backend.process(nilsimsa, chunk)
+            return
+    _table_backend.process(nilsimsa, chunk)
+
+
+def compare_digests(digest_1, digest_2, is_hex_1=True, is_hex_2=True,
+                    threshold=None):
+    """
+    nilsimsa score as a single popcount over 256-bit ints; scores below
+    `threshold` are reported as exactly `threshold - 1`
+    """
+    digest_1 = as_nilsimsa_digest(digest_1, is_hex_1)
+    digest_2 = as_nilsimsa_digest(digest_2, is_hex_2)
+    return digest_1.compare(digest_2, threshold)
@@ -0,0 +1,124 @@
+"""
+Purpose: NumPy implementation of the nilsimsa accumulator update.
+
+Instead of walking the input one byte at a time, the trigram bucket
+indices for a whole block of input are computed as array operations and
+the accumulator is filled with a single bincount over all eight
+trigrams.  The last four bytes seen are carried across calls through
+`Nilsimsa.window`, exactly as in the reference implementation, so
+feeding a document in chunks gives the same digest as feeding it whole.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+"""
+from __future__ import absolute_import
+
+import numpy as np
+
+from nilsimsa import TRAN, TRIGRAMS
+
+# Inputs are processed in blocks of this many bytes so that the
+# temporary index arrays stay a fixed size for very large chunks.
+BLOCK_SIZE = 1 << 16
+
+
+def _tran_tables():
+    """
+    splits tran_hash(a, b, c, n) into three 256-entry uint8 tables per n,
+    so that tran_hash == ((X[n][a] ^ Y[n][b]) + Z[n][c]) & 255
+    """
+    tran = np.array(TRAN, dtype=np.int64)
+    values = np.arange(256, dtype=np.int64)
+    tables = []
+    for n in range(8):
+        x = tran[(values + n) & 255]
+        y = tran * (n + n + 1)
+        z = tran[values ^ TRAN[n]]
+        tables.append(tuple((t & 255).astype(np.uint8) for t in (x, y, z)))
+    return tables
+
+TABLES = _tran_tables()
+
+# TABLES stacked into 8 x 256 arrays, with the offsets and table of each
+# trigram, so that all eight trigrams are looked up in one operation
+STACKED = [np.stack([tables[i] for tables in TABLES]) for i in range(3)]
+OFFSETS = np.array([trigram[:3] for trigram in TRIGRAMS]).T
+TRIGRAM_TABLES = np.array([trigram[3] for trigram in TRIGRAMS])[:, None]
+
+
+def bucket_counts(data, context=b''):
+    """
+    returns an array of 256 counts of the trigram buckets hit by the
+    bytes of `data`, any object supporting the buffer protocol, given up
+    to four bytes of `context` (oldest first) that immediately precede it
+
+    `data` is read in place; only the few trigrams that reach back into
+    `context` are computed from a small copy joining the two.
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    indices = _bucket_indices(buf, 0, len(buf))
+    if context:
+        head = np.frombuffer(bytes(context) + bytes(buf[:4]), dtype=np.uint8)
+        indices += _bucket_indices(head, len(context), len(head), crossing=True)
+    if not indices:
+        return np.zeros(256, dtype=np.int64)
+    return np.bincount(np.concatenate(indices), minlength=256)
+
+
+def history_counts(data):
+    """
+    returns an array of 256 counts of the trigram buckets hit by the
+    bytes of data[4:], each with all its trigrams formed from the four
+    bytes before it; a fixed number of array operations, which makes it
+    cheaper than bucket_counts for short inputs
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    shifted = np.stack([buf[4 - d:len(buf) - d] for d in range(5)])
+    x, y, z = [table[TRIGRAM_TABLES, shifted[offsets]]
+               for table, offsets in zip(STACKED, OFFSETS)]
+    return np.bincount(((x ^ y) + z).ravel(), minlength=256)
+
+
+def _bucket_indices(buf, start, end, crossing=False):
+    """
+    returns a list of arrays of the trigram buckets for the characters
+    buf[start:end]; with `crossing`, only those trigrams whose oldest
+    character is before `start` are included
+    """
+    indices = []
+    for (da, db, dc, n) in TRIGRAMS:
+        # the trigram needs at least max(offsets) characters before it
+        reach = max(da, db, dc)
+        first = max(start, reach)
+        last = min(end, start + reach) if crossing else end
+        if first >= last:
+            continue
+        x, y, z = TABLES[n]
+        # uint8 arithmetic wraps, which supplies the final & 255
+        indices.append((x[buf[first - da:last - da]] ^
+                        y[buf[first - db:last - db]]) +
+                       z[buf[first - dc:last - dc]])
+    return indices
+
+
+def process(nilsimsa, chunk):
+    """
+    adds the trigrams of the byte string `chunk` to the accumulator of
+    the Nilsimsa object `nilsimsa` and advances its window
+    """
+    if not chunk:
+        return
+    # window holds the most recent character first
+    context = bytes(bytearray(nilsimsa.window[::-1]))
+    counts = np.zeros(256, dtype=np.int64)
+    view = memoryview(chunk)
+    for offset in range(0, len(view), BLOCK_SIZE):
+        block = view[offset:offset + BLOCK_SIZE]
+        counts += bucket_counts(block, context)
+        context = (context + block[-4:].tobytes())[-4:]
+    acc = nilsimsa.acc
+    for i, count in enumerate(counts.tolist()):
+        acc[i] += count
+    nilsimsa.num_char += len(chunk)
+    nilsimsa.window = list(bytearray(context))[::-1]
@@ -0,0 +1,77 @@
+"""
+Purpose: table-driven pure Python implementation of the nilsimsa
+accumulator update, for use where NumPy is not available.
+
+tran_hash(a, b, c, n) is split into three 256-entry lookup tables per n,
+so that each trigram costs three list lookups, an xor and an add instead
+of the full tran53 arithmetic.  The sliding window is kept in local
+variables rather than rebuilding `Nilsimsa.window` for every byte, and
+counts go into a 512-entry local accumulator so the final & 255 can be
+folded in once per chunk.  The result matches the reference
+implementation in Nilsimsa.process bit for bit.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+"""
+from __future__ import absolute_import
+
+from nilsimsa import PY3, TRAN
+
+# tran_hash(a, b, c, n) == ((X[n][a] ^ Y[n][b]) + Z[n][c]) & 255
+X = [[TRAN[(v + n) & 255] for v in range(256)] for n in range(8)]
+Y = [[(TRAN[v] * (n + n + 1)) & 255 for v in range(256)] for n in range(8)]
+Z = [[TRAN[v ^ TRAN[n]] for v in range(256)] for n in range(8)]
+
+
+def process(nilsimsa, chunk):
+    """
+    adds the trigrams of the byte string `chunk` to the accumulator of
+    the Nilsimsa object `nilsimsa` and advances its window
+    """
+    if not chunk:
+        return
+    if not PY3:
+        chunk = bytearray(chunk)
+    X0, X1, X2, X3, X4, X5, X6, X7 = X
+    Y0, Y1, Y2, Y3, Y4, Y5, Y6, Y7 = Y
+    Z0, Z1, Z2, Z3, Z4, Z5, Z6, Z7 = Z
+    acc = [0] * 512
+    window = nilsimsa.window
+    nilsimsa.num_char += len(chunk)
+
+    # ramp-up: fewer than four characters seen so only the first three
+    # trigrams can be formed
+    start = 0
+    while len(window) < 4 and start < len(chunk):
+        c = chunk[start]
+        if len(window) > 1:
+            acc[(X0[c] ^ Y0[window[0]]) + Z0[window[1]]] += 1
+        if len(window) > 2:
+            acc[(X1[c] ^ Y1[window[0]]) + Z1[window[2]]] += 1
+            acc[(X2[c] ^ Y2[window[1]]) + Z2[window[2]]] += 1
+        window = [c] + window
+        start += 1
+
+    if len(window) == 4:
+        w0, w1, w2, w3 = window
+        for c in (chunk[start:] if start else chunk):
+            acc[(X0[c] ^ Y0[w0]) + Z0[w1]] += 1
+            acc[(X1[c] ^ Y1[w0]) + Z1[w2]] += 1
+            acc[(X2[c] ^ Y2[w1]) + Z2[w2]] += 1
+            acc[(X3[c] ^ Y3[w0]) + Z3[w3]] += 1
+            acc[(X4[c] ^ Y4[w1]) + Z4[w3]] += 1
+            acc[(X5[c] ^ Y5[w2]) + Z5[w3]] += 1
+            # duplicate hashes, used to maintain 8 trigrams per character
+            acc[(X6[w3] ^ Y6[w0]) + Z6[c]] += 1
+            acc[(X7[w3] ^ Y7[w2]) + Z7[c]] += 1
+            w3 = w2
+            w2 = w1
+            w1 = w0
+            w0 = c
+        window = [w0, w1, w2, w3]
+
+    nilsimsa.window = window
+    total = nilsimsa.acc
+    for i in range(256):
+        total[i] += acc[i] + acc[i + 256]
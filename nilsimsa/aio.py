@@ -0,0 +1,61 @@
+"""
+Purpose: asyncio interface for computing nilsimsa digests of byte
+streams as they arrive.
+
+digest_stream() feeds chunks from an asyncio.StreamReader, or from any
+async iterable of chunks, into Nilsimsa.process without buffering the
+whole body.  Chunks of at least `offload_threshold` bytes are hashed in
+an executor so the event loop is not blocked, and the next chunk is
+read while the previous one is being hashed.
+
+Requires Python 3.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+"""
+import asyncio
+
+from nilsimsa import CHUNK_SIZE, Nilsimsa
+
+
+async def _chunks(source, chunk_size):
+    """yields the chunks of a StreamReader-like object or async iterable"""
+    if hasattr(source, 'read'):
+        while True:
+            chunk = await source.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        async for chunk in source:
+            yield chunk
+
+
+async def digest_stream(source, chunk_size=CHUNK_SIZE, backend=None,
+                        executor=None, offload_threshold=1024):
+    """
+    returns a Nilsimsa object holding the digest of all chunks read from
+    `source`, an asyncio.StreamReader (read `chunk_size` bytes at a time)
+    or an async iterable of bytes or str chunks
+
+    Chunks of `offload_threshold` bytes or more are hashed with
+    loop.run_in_executor(executor, ...), the default executor if
+    `executor` is None; smaller chunks are hashed inline.  Set
+    `offload_threshold` to None to hash everything inline.
+    """
+    loop = asyncio.get_running_loop()
+    nil = Nilsimsa(backend=backend)
+    pending = None
+    async for chunk in _chunks(source, chunk_size):
+        # chunks must be hashed in order, so wait for the previous one
+        if pending is not None:
+            await pending
+            pending = None
+        if offload_threshold is not None and len(chunk) >= offload_threshold:
+            pending = loop.run_in_executor(executor, nil.process, chunk)
+        else:
+            nil.process(chunk)
+    if pending is not None:
+        await pending
+    return nil
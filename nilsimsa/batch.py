@@ -0,0 +1,391 @@
+"""
+Purpose: compare nilsimsa digests in bulk over packed digest matrices.
+
+Digests are stored packed as an N x 32 numpy uint8 array, one row per
+digest in the same byte order as Nilsimsa.digest and hexdigest().  Any
+bytes-like buffer whose length is a multiple of 32 is accepted wherever
+a packed matrix is expected.  Scoring one query against every row is a
+single vectorized xor and popcount pass, with no per-digest parsing or
+Python loop.
+
+Hex digests are converted to and from packed matrices in bulk with
+decode_hex(), read_hex() and encode_hex(), which validate and decode
+whole batches of lines with table lookups at millions of digests per
+second.
+
+This module requires numpy.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+"""
+from __future__ import absolute_import
+
+import io
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import nilsimsa
+from nilsimsa import POPC, NilsimsaDigest, convert_hex_to_ints, text_type
+
+# POPC as an array, used when numpy has no native bitwise_count
+_POPC = np.array(POPC, dtype=np.uint8)
+
+# value of each hex digit character, 255 for any other byte
+_HEX_VALUES = np.full(256, 255, dtype=np.uint8)
+for _i, _c in enumerate(bytearray(b'0123456789abcdef')):
+    _HEX_VALUES[_c] = _i
+for _i, _c in enumerate(bytearray(b'ABCDEF')):
+    _HEX_VALUES[_c] = 10 + _i
+
+_HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+
+# lines decoded per batch by decode_hex() and bytes read per block by
+# read_hex(), which bound their temporary memory
+HEX_BATCH_LINES = 1 << 16
+HEX_BLOCK_SIZE = 1 << 22
+
+
+def pack_digests(digests, is_hex=True):
+    """
+    packs an iterable of digests into an N x 32 uint8 array
+    takes param for format, default is hex string but can accept lists
+    of 32 ints; NilsimsaDigest objects are accepted either way
+    """
+    digests = list(digests)
+    if is_hex and all(isinstance(d, (text_type, bytes)) for d in digests):
+        packed, bad = decode_hex(digests)
+        if bad:
+            raise ValueError("Expected 64 character hex digests, got {!r}"
+                             .format(digests[bad[0]]))
+        return packed
+    packed = np.array([_digest_ints(d, is_hex) for d in digests],
+                      dtype=np.uint8)
+    return packed.reshape(-1, 32)
+
+
+def _digest_ints(digest, is_hex):
+    if isinstance(digest, NilsimsaDigest):
+        return digest.to_ints()
+    if is_hex:
+        return convert_hex_to_ints(digest)
+    return digest
+
+
+def as_packed(digests):
+    """
+    returns `digests` as an N x 32 uint8 array, without copying when it
+    already is one or is a bytes-like buffer of packed digests; any other
+    iterable of hex strings, NilsimsaDigests or lists of 32 ints is
+    packed with pack_digests()
+    """
+    if isinstance(digests, np.ndarray):
+        if digests.dtype != np.uint8:
+            digests = digests.astype(np.uint8)
+        return digests.reshape(-1, 32)
+    try:
+        memoryview(digests)
+    except TypeError:
+        # not a buffer, e.g. a list of hex digests
+        digests = list(digests)
+        is_hex = bool(digests) and isinstance(digests[0], (text_type, bytes))
+        return pack_digests(digests, is_hex=is_hex)
+    return np.frombuffer(digests, dtype=np.uint8).reshape(-1, 32)
+
+
+def _decode_hex_lines(buf):
+    """
+    decodes `buf`, a uint8 array of newline separated lines, returning
+    the packed digests of the valid lines and the line numbers of the
+    others; see decode_hex()
+    """
+    newlines = np.flatnonzero(buf == 10)
+    ends = newlines
+    if len(buf) and buf[-1] != 10:
+        ends = np.append(newlines, len(buf))
+    starts = np.concatenate(([0], newlines + 1))[:len(ends)]
+    lengths = ends - starts
+    # drop the \r of \r\n line endings
+    lengths -= (lengths > 0) & (buf[ends - 1] == 13)
+    ok = lengths == 64
+    longer = np.flatnonzero(lengths > 64)
+    ok[longer] = buf[starts[longer] + 64] == 9
+    candidates = np.flatnonzero(ok)
+    if len(buf) >= 64:
+        digits = _HEX_VALUES[sliding_window_view(buf, 64)[starts[candidates]]]
+    else:
+        digits = np.zeros((0, 64), dtype=np.uint8)
+    valid = (digits < 16).all(axis=1)
+    ok[candidates[~valid]] = False
+    digits = digits[valid]
+    packed = (digits[:, 0::2] << 4) | digits[:, 1::2]
+    return packed, np.flatnonzero(~ok)
+
+
+def decode_hex(lines):
+    """
+    decodes an iterable of hex digests into an N x 32 uint8 array,
+    returning (packed, bad) where `bad` is the list of the (0-based)
+    numbers of the lines that are not valid digests
+
+    Each line is a str or bytes holding exactly 64 hex digits, in either
+    case, optionally followed by a tab and any other fields (such as
+    the TSV output of `nilsimsa hash`) and a line ending.  Packed rows
+    are in line order, skipping bad lines.  Lines are decoded in batches
+    with vectorized lookups rather than parsed one at a time; see
+    read_hex() to decode a file without splitting it into lines first.
+    """
+    blocks = []
+    bad = []
+    offset = 0
+    batch = []
+    lines = iter(lines)
+    while True:
+        for line in lines:
+            if isinstance(line, text_type):
+                line = line.encode('utf-8')
+            # a newline inside a line would shift the line numbers
+            batch.append(line.rstrip(b'\r\n').replace(b'\n', b'\r'))
+            if len(batch) == HEX_BATCH_LINES:
+                break
+        if not batch:
+            break
+        data = b'\n'.join(batch) + b'\n'
+        packed, bad_lines = _decode_hex_lines(np.frombuffer(data, np.uint8))
+        blocks.append(packed)
+        bad.extend((bad_lines + offset).tolist())
+        offset += len(batch)
+        batch = []
+    if not blocks:
+        return np.zeros((0, 32), dtype=np.uint8), bad
+    return np.concatenate(blocks), bad
+
+
+def read_hex(f, block_size=HEX_BLOCK_SIZE):
+    """
+    decodes the hex digest lines of a file, as for decode_hex(),
+    returning (packed, bad line numbers)
+
+    `f` is a path or a binary file object, which is read `block_size`
+    bytes at a time and decoded one block of whole lines at a time.
+    """
+    if not hasattr(f, 'read'):
+        with io.open(f, 'rb') as opened:
+            return read_hex(opened, block_size)
+    blocks = []
+    bad = []
+    offset = 0
+    rest = b''
+    while True:
+        data = f.read(block_size)
+        if not data:
+            data, rest = rest, b''
+        else:
+            data = rest + data
+            cut = data.rfind(b'\n') + 1
+            data, rest = data[:cut], data[cut:]
+            if not data:
+                # no line ending yet in this block
+                continue
+        if not data:
+            break
+        buf = np.frombuffer(data, dtype=np.uint8)
+        packed, bad_lines = _decode_hex_lines(buf)
+        blocks.append(packed)
+        bad.extend((bad_lines + offset).tolist())
+        offset += len(packed) + len(bad_lines)
+    if not blocks:
+        return np.zeros((0, 32), dtype=np.uint8), bad
+    return np.concatenate(blocks), bad
+
+
+def encode_hex(digests):
+    """
+    returns the hex digests of the rows of a packed digest matrix (see
+    as_packed()) as one bytes string of newline terminated lines, the
+    inverse of read_hex()
+    """
+    packed = as_packed(digests)
+    lines = np.empty((len(packed), 65), dtype=np.uint8)
+    lines[:, 0:64:2] = _HEX_DIGITS[packed >> 4]
+    lines[:, 1:64:2] = _HEX_DIGITS[packed & 15]
+    lines[:, 64] = 10
+    return lines.tobytes()
+
+
+def unpack_digests(digests):
+    """returns the rows of a packed digest matrix as a list of hex digests"""
+    return encode_hex(digests).decode('ascii').splitlines()
+
+
+def as_query(digest, is_hex=True):
+    """returns a single digest as a 32 element uint8 array"""
+    digest = _digest_ints(digest, is_hex)
+    return np.ascontiguousarray(digest, dtype=np.uint8).reshape(32)
+
+
+def bit_differences(query, packed):
+    """
+    returns the number of differing bits between the uint8 query and each
+    row of the packed matrix
+    """
+    if hasattr(np, 'bitwise_count') and packed.flags.c_contiguous:
+        # popcount eight bytes at a time
+        diff = packed.view(np.uint64) ^ query.view(np.uint64)
+        return np.bitwise_count(diff).sum(axis=1, dtype=np.int64)
+    return _POPC[packed ^ query].sum(axis=1, dtype=np.int64)
+
+
+def compare_batch(digest, digests, is_hex=True, threshold=None):
+    """
+    computes the nilsimsa score between one digest and every row of a
+    packed digest matrix, returning an array of N scores
+
+    `digest` is a hex string by default, or a list of 32 ints if
+    `is_hex` is False, or a NilsimsaDigest.  `digests` is an N x 32 uint8 array or a packed
+    buffer, see as_packed().
+
+    If `threshold` is set, scores below `threshold` are reported as
+    `threshold - 1`, the same as compare_digests.
+    """
+    metrics = nilsimsa._metrics
+    if metrics is not None:
+        start = metrics.clock()
+    query = as_query(digest, is_hex=is_hex)
+    scores = 128 - bit_differences(query, as_packed(digests))
+    below = 0
+    if threshold is not None:
+        below_threshold = scores < threshold
+        scores[below_threshold] = threshold - 1
+        below = int(below_threshold.sum()) if metrics is not None else 0
+    if metrics is not None:
+        metrics.record_compare(below, metrics.clock() - start,
+                               count=len(scores))
+    return scores
+
+
+def top_k(digest, digests, k, is_hex=True, block_size=1 << 16):
+    """
+    returns a list of (index, score) for the `k` rows of a packed digest
+    matrix with the highest nilsimsa score against `digest`, highest
+    score first and lowest index first among equal scores
+
+    Rows are scored `block_size` at a time.  Once k rows have been seen,
+    only rows of a block scoring above the current k-th best score are
+    kept, so the selection work shrinks as the bound tightens.  See
+    compare_batch() for the accepted formats.
+    """
+    metrics = nilsimsa._metrics
+    if metrics is not None:
+        start = metrics.clock()
+    query = as_query(digest, is_hex=is_hex)
+    packed = as_packed(digests)
+    best_rows = np.zeros(0, dtype=np.int64)
+    best_scores = np.zeros(0, dtype=np.int64)
+    if k > 0:
+        for offset in range(0, len(packed), block_size):
+            scores = 128 - bit_differences(query, packed[offset:offset + block_size])
+            if len(best_scores) == k:
+                # later rows lose ties, so only strictly better ones count
+                rows = np.flatnonzero(scores > best_scores[-1])
+                if not len(rows):
+                    continue
+                scores = scores[rows]
+                rows += offset
+            else:
+                rows = np.arange(offset, offset + len(scores))
+            rows = np.concatenate((best_rows, rows))
+            scores = np.concatenate((best_scores, scores))
+            # rows are increasing, so a stable sort keeps ties in row order
+            order = np.argsort(-scores, kind='stable')[:k]
+            best_rows, best_scores = rows[order], scores[order]
+    if metrics is not None:
+        # rows pruned by the k-th best score are not threshold early exits
+        metrics.record_compare(0, metrics.clock() - start,
+                               count=len(packed))
+    return list(zip(best_rows.tolist(), best_scores.tolist()))
+
+
+def pairwise_bit_differences(packed_1, packed_2):
+    """
+    returns the len(packed_1) x len(packed_2) matrix of the number of
+    differing bits between each pair of rows
+    """
+    # accumulate one column at a time into an int16 matrix, which is much
+    # cheaper than a popcount over a 3d array summed on its short axis
+    if hasattr(np, 'bitwise_count'):
+        cols_1 = np.ascontiguousarray(packed_1).view(np.uint64).T
+        cols_2 = np.ascontiguousarray(packed_2).view(np.uint64).T
+        count = np.bitwise_count
+    else:
+        cols_1 = packed_1.T
+        cols_2 = packed_2.T
+        count = _POPC.__getitem__
+    bits = np.zeros((len(packed_1), len(packed_2)), dtype=np.int16)
+    for col_1, col_2 in zip(cols_1, cols_2):
+        bits += count(col_1[:, None] ^ col_2[None, :])
+    return bits
+
+
+def _join_tile(packed, row, col, block_size, threshold):
+    """
+    scores one block_size x block_size tile of the self-join, returning
+    arrays of the row indices, column indices and scores of the pairs
+    with row < col and score >= threshold
+    """
+    scores = 128 - pairwise_bit_differences(
+        packed[row:row + block_size], packed[col:col + block_size])
+    match = scores >= threshold
+    if row == col:
+        # diagonal tile: keep each unordered pair once, without self pairs
+        match &= np.triu(np.ones(match.shape, dtype=bool), k=1)
+    i, j = np.nonzero(match)
+    return i + row, j + col, scores[i, j]
+
+
+def self_join_tiles(digests, threshold, block_size=512, workers=None):
+    """
+    yields (rows, cols, scores) arrays for every pair of digests with
+    nilsimsa score >= `threshold`, one tile of the upper triangle at a
+    time; see self_join()
+    """
+    packed = as_packed(digests)
+    tiles = ((row, col)
+             for row in range(0, len(packed), block_size)
+             for col in range(row, len(packed), block_size))
+    if not workers or workers == 1:
+        for row, col in tiles:
+            yield _join_tile(packed, row, col, block_size, threshold)
+        return
+    # numpy releases the GIL inside the xor and popcount kernels, so a
+    # thread pool scores tiles in parallel without copying `packed`; at
+    # most 2 * workers tiles are in flight to keep memory bounded
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for row, col in tiles:
+            pending.append(executor.submit(
+                _join_tile, packed, row, col, block_size, threshold))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def self_join(digests, threshold, block_size=512, workers=None):
+    """
+    yields (i, j, score) for every pair of digests i < j whose nilsimsa
+    score is >= `threshold`
+
+    `digests` is an N x 32 uint8 array, a packed buffer, or any iterable
+    accepted by as_packed().  The pairs are computed in block_size x
+    block_size tiles, so memory use depends on the block size, not on
+    how many pairs match.  With `workers` > 1, tiles are scored by a pool
+    of that many threads; pairs are yielded in the same order either way.
+    """
+    for rows, cols, scores in self_join_tiles(
+            digests, threshold, block_size=block_size, workers=workers):
+        for i, j, score in zip(rows.tolist(), cols.tolist(), scores.tolist()):
+            yield i, j, score
@@ -0,0 +1,264 @@
+"""
+Purpose: benchmark suite for the nilsimsa package.
+
+Measures, with no network access and using only the test_data corpus:
+  * digest throughput in MB/s for each backend and for the deprecated
+    implementation, when it is installed, over several document size
+    classes
+  * compare_digests pairs per second on hex strings, with and without
+    a threshold, and on NilsimsaDigest objects
+  * rolling window digests per second, against hashing each window
+    afresh, for a large and a small step
+  * batch, sharded multi-threaded, self-join and index query rates,
+    where their dependencies are available
+
+Every result is a rate, so higher is better.  Results are written as
+JSON, and when a baseline file from an earlier run is given, any rate
+that dropped by more than the tolerance is reported as a regression
+and the exit status is 1.
+
+Usage: python -m nilsimsa.bench [--quick] [--output FILE]
+                                [--baseline FILE] [--tolerance FRACTION]
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+from nilsimsa import (Nilsimsa, NilsimsaDigest, available_backends,
+                      compare_digests)
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time   # Python 2
+
+test_data_dir = os.path.join(os.path.dirname(__file__), "test_data")
+
+# document size classes, in bytes
+SIZES = {'small': 1 << 10, 'medium': 1 << 16, 'large': 1 << 20}
+QUICK_SIZES = {'small': 1 << 10, 'medium': 1 << 14}
+
+
+def load_corpus():
+    """returns the contents of the test_data documents, sorted by name"""
+    corpus = []
+    for fname in sorted(os.listdir(test_data_dir)):
+        if fname.endswith('.txt'):
+            with open(os.path.join(test_data_dir, fname), "rb") as f:
+                corpus.append(f.read())
+    return corpus
+
+
+def documents(corpus, size, total):
+    """
+    returns documents of `size` bytes cut from the concatenated corpus,
+    repeated as needed, adding up to at least `total` bytes
+    """
+    text = b''.join(corpus)
+    while len(text) < max(size, total):
+        text += text
+    count = max(1, total // size)
+    step = max(1, (len(text) - size) // count)
+    return [text[i * step:i * step + size] for i in range(count)]
+
+
+def measure(func, min_time):
+    """
+    calls func() repeatedly for at least `min_time` seconds and returns
+    the shortest time taken by one call
+    """
+    best = None
+    spent = 0.0
+    while best is None or spent < min_time:
+        start = clock()
+        func()
+        elapsed = max(clock() - start, 1e-9)
+        spent += elapsed
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_digests(corpus, sizes, min_time):
+    """digest throughput in MB/s per implementation and size class"""
+    impls = [(backend, lambda data, backend=backend:
+                  Nilsimsa(data, backend=backend).hexdigest())
+             for backend in available_backends()]
+    try:
+        # nilsimsa.deprecated is only present in a source checkout
+        from nilsimsa.deprecated._deprecated_nilsimsa import (
+            Nilsimsa as orig_Nilsimsa)
+    except ImportError:
+        pass
+    else:
+        impls.append(('deprecated',
+                      lambda data: orig_Nilsimsa(data).hexdigest()))
+    results = {}
+    for size_name, size in sorted(sizes.items()):
+        docs = documents(corpus, size, total=max(size, 1 << 16))
+        nbytes = sum(len(doc) for doc in docs)
+        for impl_name, digest in impls:
+            elapsed = measure(lambda: [digest(doc) for doc in docs], min_time)
+            key = 'digest.%s.%s.MBps' % (impl_name, size_name)
+            results[key] = nbytes / elapsed / 1e6
+    return results
+
+
+def bench_compare(hexdigests, min_time):
+    """compare_digests pairs per second"""
+    pairs = [(a, b) for a in hexdigests for b in hexdigests]
+    compact = [(NilsimsaDigest.from_hex(a), NilsimsaDigest.from_hex(b))
+               for a, b in pairs]
+    results = {}
+    elapsed = measure(lambda: [compare_digests(a, b) for a, b in pairs],
+                      min_time)
+    results['compare.hex.pairs_per_s'] = len(pairs) / elapsed
+    elapsed = measure(lambda: [compare_digests(a, b, threshold=110)
+                               for a, b in pairs], min_time)
+    results['compare.hex_threshold.pairs_per_s'] = len(pairs) / elapsed
+    elapsed = measure(lambda: [compare_digests(a, b) for a, b in compact],
+                      min_time)
+    results['compare.compact.pairs_per_s'] = len(pairs) / elapsed
+    return results
+
+
+def bench_rolling(corpus, min_time, size):
+    """
+    rolling window digests per second, and the rate of recomputing each
+    window with a fresh Nilsimsa
+    """
+    from nilsimsa.rolling import rolling_digests
+    text = documents(corpus, size, size)[0]
+    results = {}
+    for window_size, step in [(4096, 256), (1024, 16)]:
+        starts = range(0, len(text) - window_size + 1, step)
+        name = 'w%d_s%d' % (window_size, step)
+        elapsed = measure(lambda: list(rolling_digests(text, window_size,
+                                                       step)), min_time)
+        results['rolling.%s.windows_per_s' % name] = len(starts) / elapsed
+        elapsed = measure(lambda: [Nilsimsa(text[start:start + window_size])
+                                   .hexdigest() for start in starts],
+                          min_time)
+        results['rolling.recompute_%s.windows_per_s' % name] = (
+            len(starts) / elapsed)
+    return results
+
+
+def bench_batch(hexdigests, min_time, rows):
+    """batch comparison and self-join rates, if numpy is available"""
+    try:
+        import numpy as np
+        from nilsimsa.batch import compare_batch, pack_digests, self_join
+    except ImportError:
+        return {}
+    packed = pack_digests(hexdigests)
+    matrix = np.resize(packed, (rows, 32))
+    results = {}
+    elapsed = measure(lambda: compare_batch(hexdigests[0], matrix), min_time)
+    results['batch.compare.rows_per_s'] = rows / elapsed
+    from nilsimsa.search import ShardedSearch
+    with ShardedSearch(matrix) as search:
+        elapsed = measure(lambda: search.compare(hexdigests[0]), min_time)
+    results['batch.sharded_compare.rows_per_s'] = rows / elapsed
+    join_rows = min(rows, 4096)
+    elapsed = measure(lambda: list(self_join(matrix[:join_rows], 120)),
+                      min_time)
+    pairs = join_rows * (join_rows - 1) / 2
+    results['batch.self_join.pairs_per_s'] = pairs / elapsed
+    return results
+
+
+def bench_index(hexdigests, min_time):
+    """NilsimsaIndex and BKTree queries per second"""
+    from nilsimsa.index import BKTree, NilsimsaIndex
+    index = NilsimsaIndex(bands=16)
+    for i, digest in enumerate(hexdigests):
+        index.insert(i, digest)
+    tree = BKTree.from_digests(hexdigests)
+    results = {}
+    elapsed = measure(lambda: [index.query(d, 90) for d in hexdigests],
+                      min_time)
+    results['index.mih_query.queries_per_s'] = len(hexdigests) / elapsed
+    elapsed = measure(lambda: [tree.nearest(d, 5) for d in hexdigests],
+                      min_time)
+    results['index.bktree_top5.queries_per_s'] = len(hexdigests) / elapsed
+    return results
+
+
+def run(quick=False):
+    """runs the whole suite and returns the results as a dict"""
+    min_time = 0.05 if quick else 0.5
+    corpus = load_corpus()
+    hexdigests = [Nilsimsa(text, backend='table').hexdigest()
+                  for text in corpus]
+    sizes = QUICK_SIZES if quick else SIZES
+    results = {}
+    results.update(bench_digests(corpus, sizes, min_time))
+    results.update(bench_compare(hexdigests, min_time))
+    results.update(bench_rolling(corpus, min_time,
+                                 1 << 14 if quick else 1 << 16))
+    results.update(bench_batch(hexdigests, min_time,
+                               10000 if quick else 1000000))
+    results.update(bench_index(hexdigests, min_time))
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'quick': quick,
+        'results': results,
+    }
+
+
+def regressions(results, baseline, tolerance):
+    """
+    returns a list of (name, value, baseline value) for the rates in
+    `results` that are more than `tolerance` (a fraction) below the same
+    rate in `baseline`; rates missing from either are skipped
+    """
+    found = []
+    current = results['results']
+    for name, base_value in sorted(baseline['results'].items()):
+        value = current.get(name)
+        if value is not None and value < base_value * (1 - tolerance):
+            found.append((name, value, base_value))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the nilsimsa package on the test_data corpus.')
+    parser.add_argument('--quick', action='store_true',
+                        help='smaller inputs and shorter timings')
+    parser.add_argument('--output', help='write JSON results to this file')
+    parser.add_argument('--baseline',
+                        help='JSON results of an earlier run to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fractional slowdown reported as a regression')
+    args = parser.parse_args(argv)
+
+    results = run(quick=args.quick)
+    for name, value in sorted(results['results'].items()):
+        print('%-45s %14.2f' % (name, value))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.tolerance)
+        for name, value, base_value in found:
+            print('REGRESSION %s: %.2f < %.2f' % (name, value, base_value))
+        if found:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
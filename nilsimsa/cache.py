@@ -0,0 +1,151 @@
+"""
+Purpose: content-addressed cache of nilsimsa digests.
+
+Crawls see the same exact bytes many times, and hashing them again gives
+the same digest.  DigestCache keys each input by a fast exact hash of
+its bytes and returns the stored nilsimsa digest on a hit, so only new
+content pays for Nilsimsa.process.  The in-memory tier is an LRU bounded
+by number of entries and by approximate memory use.  An optional dbm
+file keeps digests across restarts.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+"""
+from __future__ import absolute_import
+
+import binascii
+import hashlib
+import threading
+from collections import OrderedDict
+
+from nilsimsa import Nilsimsa, text_type
+
+try:
+    import dbm
+except ImportError:
+    import anydbm as dbm    # Python 2
+
+if hasattr(hashlib, 'blake2b'):
+    def exact_hash(data):
+        """returns a 16 byte exact hash of `data`"""
+        return hashlib.blake2b(data, digest_size=16).digest()
+else:
+    def exact_hash(data):
+        """returns a 16 byte exact hash of `data`"""
+        return hashlib.md5(data).digest()
+
+# approximate memory used by one in-memory entry: a 16 byte key and a 32
+# byte digest as bytes objects, plus the ordered dict slot
+ENTRY_SIZE = 2 * 33 + 32 + 16 + 100
+
+
+class DigestCache(object):
+    """
+    LRU cache from exact input bytes to nilsimsa digest, see the module
+    docstring
+
+    At most `max_entries` digests, and at most `max_bytes` bytes of
+    approximate memory (ENTRY_SIZE per entry), are kept in memory; the
+    least recently used are evicted first.  If `path` is set, digests are
+    also written to a dbm file there and looked up in it on a memory
+    miss.  `backend` is passed to Nilsimsa on a miss.
+    """
+    def __init__(self, max_entries=100000, max_bytes=None, path=None,
+                 backend=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = dbm.open(path, 'c') if path is not None else None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """closes the on-disk tier, if any"""
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+    @property
+    def size(self):
+        """approximate bytes of memory used by the in-memory entries"""
+        return len(self._entries) * ENTRY_SIZE
+
+    def stats(self):
+        """returns the cache counters as a dict"""
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (self.hits + self.disk_hits) / float(lookups)
+                        if lookups else 0.0,
+        }
+
+    def _store(self, key, digest):
+        """adds an entry to memory, evicting as needed; call under the lock"""
+        self._entries[key] = digest
+        while self._entries and (
+                len(self._entries) > self.max_entries or
+                (self.max_bytes is not None and self.size > self.max_bytes)):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _lookup(self, key):
+        """returns the raw digest for `key` or None, counting a hit"""
+        with self._lock:
+            digest = self._entries.get(key)
+            if digest is not None:
+                self._entries[key] = self._entries.pop(key)
+                self.hits += 1
+                return digest
+            if self._disk is not None and key in self._disk:
+                digest = self._disk[key]
+                self._store(key, digest)
+                self.disk_hits += 1
+                return digest
+        return None
+
+    def lookup(self, data):
+        """returns the cached hexdigest of `data`, or None"""
+        if isinstance(data, text_type):
+            data = data.encode('utf-8')
+        digest = self._lookup(exact_hash(data))
+        if digest is None:
+            return None
+        return binascii.hexlify(digest).decode('ascii')
+
+    def hexdigest(self, data):
+        """
+        returns the nilsimsa hexdigest of the string `data`, from the cache
+        if these exact bytes were seen before and computed otherwise
+        """
+        if isinstance(data, text_type):
+            data = data.encode('utf-8')
+        key = exact_hash(data)
+        digest = self._lookup(key)
+        if digest is None:
+            nil = Nilsimsa(data, backend=self.backend)
+            digest = bytes(bytearray(nil.digest))
+            with self._lock:
+                self.misses += 1
+                self._store(key, digest)
+                if self._disk is not None:
+                    self._disk[key] = digest
+        return binascii.hexlify(digest).decode('ascii')
@@ -0,0 +1,112 @@
+"""
+Purpose: split documents at content-defined boundaries and compute a
+nilsimsa digest per chunk.
+
+A single 256-bit digest of a very large document washes out local
+similarity, and chunks cut at fixed offsets all change when text is
+inserted near the start.  chunk_digests() instead cuts wherever a gear
+rolling hash of the last 32 bytes has its top bits clear, so boundaries
+move with the content, and feeds each chunk through Nilsimsa.process as
+it streams past, so memory use does not depend on chunk or document
+size.  matching_fraction() compares two documents by the fraction of
+chunks of one that have a close match in the other.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+"""
+from __future__ import absolute_import
+
+import hashlib
+
+from nilsimsa import (PY3, Nilsimsa, NilsimsaDigest, byte_view,
+                      supports_buffer, text_type)
+
+# gear table: one fixed pseudo-random 32-bit value per byte value
+GEAR = [int(hashlib.md5(bytes(bytearray([i]))).hexdigest()[:8], 16)
+        for i in range(256)]
+
+
+def chunk_digests(data, avg_size=4096, min_size=None, max_size=None,
+                  backend=None):
+    """
+    yields (offset, length, hexdigest) for each content-defined chunk of
+    `data`, a string, a bytes-like buffer or an iterator over chunks as
+    accepted by Nilsimsa
+
+    `avg_size` must be a power of two and sets the expected chunk length;
+    chunks are never shorter than `min_size` (default avg_size / 4),
+    except the last one, or longer than `max_size` (default 4 * avg_size).
+    """
+    if avg_size < 1 or avg_size & (avg_size - 1):
+        raise ValueError("Expected a power of two avg_size, got {}"
+                         .format(avg_size))
+    if min_size is None:
+        min_size = avg_size // 4
+    if max_size is None:
+        max_size = avg_size * 4
+    bits = avg_size.bit_length() - 1
+    mask = ((1 << bits) - 1) << (32 - bits)
+    if isinstance(data, (bytes, text_type)) or supports_buffer(data):
+        data = [data]
+
+    def new_nilsimsa():
+        return Nilsimsa(backend=backend)
+
+    nil = new_nilsimsa()
+    offset = 0          # offset of the current chunk in the stream
+    length = 0          # bytes of the current chunk seen so far
+    h = 0
+    for block in data:
+        if isinstance(block, text_type):
+            block = block.encode('utf-8')
+        elif not isinstance(block, bytes):
+            # offsets are in bytes, whatever the buffer's item size
+            block = byte_view(block)
+        start = 0       # start of the unhashed part of block
+        # bytes and flat memoryviews yield ints, so iterate without a copy
+        for i, c in enumerate(block if PY3 else bytearray(block)):
+            h = ((h << 1) + GEAR[c]) & 0xffffffff
+            length += 1
+            if length >= max_size or (length >= min_size and not h & mask):
+                nil.process(block[start:i + 1])
+                yield offset, length, nil.hexdigest()
+                offset += length
+                length = 0
+                h = 0
+                start = i + 1
+                nil = new_nilsimsa()
+        if start < len(block):
+            nil.process(block[start:])
+    if length:
+        yield offset, length, nil.hexdigest()
+
+
+def matching_fraction(chunks_1, chunks_2, threshold):
+    """
+    returns the fraction of the chunks in `chunks_1` that score at least
+    `threshold` against some chunk in `chunks_2`; chunks are the
+    (offset, length, hexdigest) tuples from chunk_digests()
+    """
+    return matching_fractions(chunks_1, [chunks_2], threshold)[0]
+
+
+def matching_fractions(chunks, documents, threshold):
+    """
+    returns, for each chunk list in `documents`, the fraction of the
+    chunks in `chunks` that score at least `threshold` against one of
+    its chunks, see matching_fraction()
+    """
+    query = [NilsimsaDigest.from_hex(digest) for _, _, digest in chunks]
+    fractions = []
+    for document in documents:
+        others = set(NilsimsaDigest.from_hex(digest)
+                     for _, _, digest in document)
+        if not query:
+            fractions.append(0.0)
+            continue
+        matched = sum(1 for digest in query
+                      if any(digest.compare(other) >= threshold
+                             for other in others))
+        fractions.append(matched / float(len(query)))
+    return fractions
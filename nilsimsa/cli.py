@@ -0,0 +1,252 @@
+"""
+Purpose: the `nilsimsa` command-line tool.
+
+    nilsimsa hash [-w N] [-f tsv|ndjson] PATH...
+        digests files, directories (recursively) or stdin ("-"), hashing
+        files in parallel worker processes with streaming reads, and
+        prints one line per file
+
+    nilsimsa compare DIGEST DIGEST
+        prints the nilsimsa score between two hex digests
+
+    nilsimsa search -d DIGEST_FILE [-t THRESHOLD] [-k TOP] QUERY...
+        scores each query hex digest ("-" reads queries from stdin, one
+        per line) against every digest in DIGEST_FILE and prints the
+        matches
+
+DIGEST_FILE and the query input use the output format of `nilsimsa hash`:
+either TSV lines of "hexdigest<TAB>id" or NDJSON objects with "digest"
+and "path" fields.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import itertools
+import json
+import os
+import sys
+from collections import OrderedDict
+
+from nilsimsa import BACKENDS, Nilsimsa, NilsimsaDigest, compare_digests
+from nilsimsa.parallel import digest_files
+
+
+def iter_paths(paths):
+    """yields the files named by `paths`, walking directories recursively"""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def format_result(fmt, fields):
+    """formats a list of (name, value) output fields as one TSV or NDJSON line"""
+    if fmt == 'ndjson':
+        return json.dumps(OrderedDict(fields))
+    return '\t'.join('' if value is None else u'%s' % (value,)
+                     for name, value in fields)
+
+
+def read_digests(lines, source):
+    """
+    yields (hexdigest, id, error) from TSV or NDJSON lines read from
+    `source`, skipping blank lines and lines whose digest is missing; for
+    a line that cannot be parsed, hexdigest is None, id is "source:line"
+    and error is the exception
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('{'):
+            try:
+                record = json.loads(line)
+            except ValueError as exc:
+                yield None, '%s:%d' % (source, number), exc
+                continue
+            digest, name = record.get('digest'), record.get('path')
+        else:
+            fields = line.split('\t', 1)
+            digest = fields[0]
+            name = fields[1] if len(fields) > 1 else str(number)
+        if digest:
+            yield digest, name, None
+
+
+HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+
+
+def parse_digest(digest):
+    """
+    returns the hex digest `digest` as a NilsimsaDigest, raising
+    ValueError if it is not exactly 64 hex digits
+    """
+    if len(digest) != 64 or not HEX_DIGITS.issuperset(digest):
+        raise ValueError('not a 64 character hex digest')
+    return NilsimsaDigest.from_hex(digest)
+
+
+def report_error(where, error):
+    print('nilsimsa: %s: %s' % (where, error), file=sys.stderr)
+
+
+def checked_digests(records, failures):
+    """
+    yields (hexdigest, id) from the (hexdigest, id, error) `records` of
+    read_digests, reporting unreadable lines and malformed digests on
+    stderr and appending them to the list `failures` instead
+    """
+    for digest, name, error in records:
+        if error is None:
+            try:
+                parse_digest(digest)
+            except ValueError as exc:
+                name, error = digest, exc
+        if error is not None:
+            report_error(name, error)
+            failures.append(name)
+            continue
+        yield digest, name
+
+
+def cmd_hash(args, out):
+    failed = False
+    results = []
+    if '-' in args.paths:
+        nil = Nilsimsa(backend=args.backend)
+        nil.from_stream(getattr(sys.stdin, 'buffer', sys.stdin))
+        results.append(('-', nil.hexdigest(), None))
+    paths = iter_paths(path for path in args.paths if path != '-')
+    results = itertools.chain(results, digest_files(
+        paths, workers=args.workers, chunksize=args.chunksize,
+        ordered=not args.unordered, backend=args.backend))
+    for path, digest, error in results:
+        if error is not None:
+            failed = True
+            report_error(path, error)
+            if args.format != 'ndjson':
+                continue
+        fields = [('digest', digest), ('path', path)]
+        if args.format == 'ndjson':
+            fields.append(('error', None if error is None else str(error)))
+        out.write(format_result(args.format, fields) + '\n')
+    return 1 if failed else 0
+
+
+def cmd_compare(args, out):
+    digests = []
+    for digest in (args.digest_1, args.digest_2):
+        try:
+            digests.append(parse_digest(digest))
+        except ValueError as exc:
+            report_error(digest, exc)
+            return 1
+    out.write('%d\n' % compare_digests(*digests))
+    return 0
+
+
+def cmd_search(args, out):
+    failures = []
+    with open(args.digests) as f:
+        stored = list(checked_digests(read_digests(f, args.digests),
+                                      failures))
+    names = [name for digest, name in stored]
+    score_all = _scorer([digest for digest, name in stored])
+    if args.queries == ['-']:
+        records = read_digests(sys.stdin, '-')
+    else:
+        records = ((query, query, None) for query in args.queries)
+    for query, query_name in checked_digests(records, failures):
+        scores = score_all(query)
+        matches = [(score, i) for i, score in enumerate(scores)
+                   if score >= args.threshold]
+        matches.sort(key=lambda match: -match[0])
+        if args.top is not None:
+            matches = matches[:args.top]
+        for score, i in matches:
+            fields = [('query', query_name), ('match', names[i]),
+                      ('score', score)]
+            out.write(format_result(args.format, fields) + '\n')
+    return 1 if failures else 0
+
+
+def _scorer(digests):
+    """
+    returns a function scoring one hex digest against all of `digests`,
+    vectorized when numpy is available
+    """
+    try:
+        from nilsimsa.batch import compare_batch, pack_digests
+    except ImportError:
+        compact = [NilsimsaDigest.from_hex(digest) for digest in digests]
+        return lambda query: [compare_digests(NilsimsaDigest.from_hex(query), d)
+                              for d in compact]
+    packed = pack_digests(digests)
+    return lambda query: compare_batch(query, packed).tolist()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='nilsimsa', description='Compute and compare nilsimsa digests.')
+    commands = parser.add_subparsers(dest='command')
+
+    hash_parser = commands.add_parser(
+        'hash', help='digest files, directories or stdin')
+    hash_parser.add_argument('paths', nargs='+', metavar='PATH',
+                             help='file or directory to digest, - for stdin')
+    hash_parser.add_argument('-w', '--workers', type=int, default=None,
+                             help='worker processes (default: one per cpu)')
+    hash_parser.add_argument('--chunksize', type=int, default=16,
+                             help='files sent to a worker at a time')
+    hash_parser.add_argument('--unordered', action='store_true',
+                             help='print results as they complete')
+    hash_parser.add_argument('-b', '--backend', choices=sorted(BACKENDS),
+                             help='hashing backend')
+    hash_parser.add_argument('-f', '--format', choices=('tsv', 'ndjson'),
+                             default='tsv')
+    hash_parser.set_defaults(func=cmd_hash)
+
+    compare_parser = commands.add_parser(
+        'compare', help='score two hex digests')
+    compare_parser.add_argument('digest_1')
+    compare_parser.add_argument('digest_2')
+    compare_parser.set_defaults(func=cmd_compare)
+
+    search_parser = commands.add_parser(
+        'search', help='score queries against a digest file')
+    search_parser.add_argument('queries', nargs='+', metavar='QUERY',
+                               help='hex digest, or - to read from stdin')
+    search_parser.add_argument('-d', '--digests', required=True,
+                               help='file of digests from `nilsimsa hash`')
+    search_parser.add_argument('-t', '--threshold', type=int, default=0,
+                               help='minimum score to report (default 0)')
+    search_parser.add_argument('-k', '--top', type=int, default=None,
+                               help='report at most this many per query')
+    search_parser.add_argument('-f', '--format', choices=('tsv', 'ndjson'),
+                               default='tsv')
+    search_parser.set_defaults(func=cmd_search)
+    return parser
+
+
+def main(argv=None, out=None):
+    args = build_parser().parse_args(argv)
+    if not getattr(args, 'func', None):
+        build_parser().print_usage(sys.stderr)
+        return 2
+    try:
+        return args.func(args, out or sys.stdout)
+    except BrokenPipeError:
+        # output piped into e.g. head
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
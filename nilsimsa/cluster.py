@@ -0,0 +1,151 @@
+"""
+Purpose: group near-duplicate documents into clusters.
+
+Documents are numbered 0, 1, 2, ... and a cluster is a connected
+component of the graph whose edges are pairs of documents scoring at
+least a threshold.  UnionFind stores the components in a single array
+of 4 byte parent indices; the representative of a cluster is always
+its lowest numbered (first seen) document.
+
+Pairs can come from nilsimsa.batch.self_join via cluster_pairs(), or
+documents can be added one at a time as they arrive with
+IncrementalClusterer, which finds each new document's neighbours with a
+nilsimsa.index.PackedIndex.  Memory then grows by a fixed amount per
+document: 4 bytes of parent index plus 32 bytes of packed digest and 4
+bytes per band of the index, about 100 bytes with the default 16 bands.
+On top of that the index keeps one small array per distinct band value,
+which is why a million random documents measure about 270 bytes each;
+the overhead is shared, so tens of millions of documents fit in a few
+GB.  A caller can pass its own index instead.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+"""
+from __future__ import absolute_import
+
+from array import array
+
+from nilsimsa.index import PackedIndex
+
+
+class UnionFind(object):
+    """
+    disjoint sets over the integers 0 .. len(self) - 1, with path halving
+    and the smallest member of each set as its root
+    """
+    def __init__(self, size=0):
+        self._parent = array('i', range(size))
+
+    def __len__(self):
+        return len(self._parent)
+
+    def add(self):
+        """adds a new singleton set and returns its element"""
+        element = len(self._parent)
+        self._parent.append(element)
+        return element
+
+    def grow(self, size):
+        """adds singleton sets until there are `size` elements"""
+        if size > len(self._parent):
+            self._parent.extend(range(len(self._parent), size))
+
+    def find(self, element):
+        """returns the representative (smallest member) of element's set"""
+        parent = self._parent
+        while parent[element] != element:
+            parent[element] = parent[parent[element]]
+            element = parent[element]
+        return element
+
+    def union(self, element_1, element_2):
+        """merges the sets of two elements, returning the new representative"""
+        root_1 = self.find(element_1)
+        root_2 = self.find(element_2)
+        if root_1 < root_2:
+            self._parent[root_2] = root_1
+            return root_1
+        self._parent[root_1] = root_2
+        return root_2
+
+    def labels(self):
+        """returns an array holding the representative of every element"""
+        return array('i', (self.find(i) for i in range(len(self._parent))))
+
+    def clusters(self, min_size=2):
+        """
+        returns a dict from representative to the sorted list of members,
+        for every set with at least `min_size` members
+        """
+        labels = self.labels()
+        # count first, so no list is built for sets that are too small
+        sizes = array('i', [0]) * len(labels)
+        for root in labels:
+            sizes[root] += 1
+        members = {}
+        for element, root in enumerate(labels):
+            if sizes[root] >= min_size:
+                members.setdefault(root, []).append(element)
+        return members
+
+
+def cluster_pairs(pairs, size=0, union_find=None):
+    """
+    merges each (i, j, ...) pair, e.g. the (i, j, score) tuples yielded by
+    nilsimsa.batch.self_join, into `union_find` (a new UnionFind of `size`
+    elements by default, grown as needed) and returns it
+    """
+    if union_find is None:
+        union_find = UnionFind(size)
+    for pair in pairs:
+        i, j = pair[0], pair[1]
+        union_find.grow(max(i, j) + 1)
+        union_find.union(i, j)
+    return union_find
+
+
+class IncrementalClusterer(object):
+    """
+    clusters documents as they arrive: each digest added is linked to
+    every earlier digest scoring at least `threshold` against it
+
+    Neighbours are found with a PackedIndex of `bands` bands, or with
+    `index`, an empty NilsimsaIndex or any other index with its
+    insert(key, digest, is_hex) and query(digest, threshold, is_hex)
+    methods.
+    """
+    def __init__(self, threshold, bands=16, index=None):
+        self.threshold = threshold
+        if index is None:
+            index = PackedIndex(bands)
+        self.index = index
+        self.union_find = UnionFind()
+
+    def __len__(self):
+        return len(self.union_find)
+
+    def add(self, digest, is_hex=True):
+        """
+        adds a document's digest and returns (document number,
+        representative of its cluster)
+        """
+        element = self.union_find.add()
+        root = element
+        for other, score in self.index.query(digest, self.threshold,
+                                             is_hex=is_hex):
+            root = self.union_find.union(element, other)
+        if isinstance(self.index, PackedIndex):
+            # rows are numbered in the same order as documents
+            self.index.append(digest, is_hex=is_hex)
+        else:
+            self.index.insert(element, digest, is_hex=is_hex)
+        return element, root
+
+    def representative(self, element):
+        """returns the representative of document `element`'s cluster"""
+        return self.union_find.find(element)
+
+    def clusters(self, min_size=2):
+        """see UnionFind.clusters"""
+        return self.union_find.clusters(min_size)
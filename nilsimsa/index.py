@@ -0,0 +1,348 @@
+"""
+Purpose: indexes of nilsimsa digests for similarity queries that do not
+scan the whole corpus.
+
+NilsimsaIndex implements multi-index hashing: each 256-bit digest is
+split into `bands` contiguous bit ranges and every band gets its own
+exact-match hash table.  Two digests whose bit difference is at most d
+must agree to within d // bands bits on at least one band (pigeonhole),
+so a query only has to look up band values within that radius of its
+own bands.  With bands > d this is a plain exact-match lookup per band.
+The candidates found this way are verified with compare_digests, so the
+results are exact.  PackedIndex uses the same band tables for an
+append-only corpus keyed by insertion number, keeping each digest as 32
+packed bytes and each band entry as a 4 byte row number, for corpora of
+tens of millions.
+
+BKTree is a Burkhard-Keller tree over the bit difference between
+digests, which is a true Hamming metric.  It answers exact range and
+top-k queries, pruning subtrees with the triangle inequality, for when
+recall must be 100% and the corpus is too large to scan.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+"""
+from __future__ import absolute_import
+
+import heapq
+from array import array
+from itertools import combinations
+
+from nilsimsa import (NilsimsaDigest, as_nilsimsa_digest, compare_digests,
+                      popcount)
+
+
+def bands_for_threshold(threshold, radius=0):
+    """
+    returns the smallest number of bands for which a NilsimsaIndex query
+    at `threshold` only has to probe band values within `radius` bits;
+    radius 0 means every query is an exact lookup in each band table
+    """
+    max_bits = 128 - threshold
+    if max_bits < 0:
+        return 1
+    return min(256, max_bits // (radius + 1) + 1)
+
+
+class _BandTables(object):
+    """
+    the band tables shared by NilsimsaIndex and PackedIndex: for each of
+    `bands` bands of the digest bits, a dict from band value to a
+    collection of the keys whose digest has that value
+    """
+    def __init__(self, bands):
+        if not 1 <= bands <= 256:
+            raise ValueError("Expected 1 <= bands <= 256, got {}".format(bands))
+        self.bands = bands
+        # band i covers bits [shifts[i], shifts[i] + widths[i]) of the digest
+        self.widths = [256 // bands + (i < 256 % bands) for i in range(bands)]
+        self.shifts = [sum(self.widths[:i]) for i in range(bands)]
+        self.tables = [{} for i in range(bands)]
+
+    def values(self, digest):
+        """returns the band values of the NilsimsaDigest `digest`"""
+        value = int(digest)
+        return [(value >> shift) & ((1 << width) - 1)
+                for shift, width in zip(self.shifts, self.widths)]
+
+    def candidates(self, digest, threshold):
+        """
+        returns the set of keys that may score >= `threshold` against the
+        NilsimsaDigest `digest`, i.e. whose digest is within the probe
+        radius of the query on at least one band
+        """
+        max_bits = 128 - threshold
+        if max_bits < 0:
+            return set()
+        radius = max_bits // self.bands
+        found = set()
+        for table, width, band in zip(self.tables, self.widths,
+                                      self.values(digest)):
+            if _num_probes(width, radius) <= len(table):
+                for probe in _probes(band, width, radius):
+                    keys = table.get(probe)
+                    if keys:
+                        found.update(keys)
+            else:
+                # fewer stored band values than probes, so scan the table
+                for value, keys in table.items():
+                    if popcount(value ^ band) <= radius:
+                        found.update(keys)
+        return found
+
+
+def _verify(digest, keys, get, threshold):
+    """
+    returns a list of (key, score) for the `keys` whose digest, looked up
+    with get(key), scores >= `threshold` against `digest`, highest score
+    first
+    """
+    results = []
+    for key in keys:
+        score = compare_digests(digest, get(key))
+        if score >= threshold:
+            results.append((key, score))
+    results.sort(key=lambda result: -result[1])
+    return results
+
+
+class NilsimsaIndex(object):
+    """
+    multi-index hash of nilsimsa digests keyed by document id, see the
+    module docstring
+
+    More bands mean narrower tables and fewer probes per query, at the
+    cost of more tables and more candidates per probe; see
+    bands_for_threshold() to pick a value for a given threshold.
+    """
+    def __init__(self, bands=16):
+        self._bands = _BandTables(bands)
+        self.bands = bands
+        self.widths = self._bands.widths
+        self.shifts = self._bands.shifts
+        self._digests = {}
+
+    def __len__(self):
+        return len(self._digests)
+
+    def __contains__(self, key):
+        return key in self._digests
+
+    def get(self, key):
+        """returns the NilsimsaDigest stored for `key`"""
+        return self._digests[key]
+
+    def insert(self, key, digest, is_hex=True):
+        """
+        adds `digest` to the index under document id `key`, replacing any
+        digest already stored for `key`
+        """
+        digest = as_nilsimsa_digest(digest, is_hex)
+        if key in self._digests:
+            self.delete(key)
+        self._digests[key] = digest
+        for table, band in zip(self._bands.tables, self._bands.values(digest)):
+            table.setdefault(band, set()).add(key)
+
+    def delete(self, key):
+        """removes the digest stored under `key`, raising KeyError if absent"""
+        digest = self._digests.pop(key)
+        for table, band in zip(self._bands.tables, self._bands.values(digest)):
+            keys = table[band]
+            keys.discard(key)
+            if not keys:
+                del table[band]
+
+    def candidates(self, digest, threshold, is_hex=True):
+        """
+        returns the set of keys that may score >= `threshold` against
+        `digest`, i.e. whose digest is within the probe radius of the
+        query on at least one band
+        """
+        digest = as_nilsimsa_digest(digest, is_hex)
+        return self._bands.candidates(digest, threshold)
+
+    def query(self, digest, threshold, is_hex=True):
+        """
+        returns a list of (key, score) for every stored digest whose
+        nilsimsa score against `digest` is >= `threshold`, highest
+        score first
+        """
+        digest = as_nilsimsa_digest(digest, is_hex)
+        return _verify(digest, self._bands.candidates(digest, threshold),
+                       self.get, threshold)
+
+
+class PackedIndex(object):
+    """
+    append-only multi-index hash of nilsimsa digests, found by the
+    insertion numbers 0, 1, 2, ... that append() returns; it answers
+    the same queries as a NilsimsaIndex, but cannot replace or delete
+    digests
+
+    Digests are packed 32 bytes each in one bytearray and each band value
+    maps to an array of 4 byte row numbers, about 32 + 4 * bands bytes
+    per digest plus one array per distinct band value.
+    """
+    def __init__(self, bands=16):
+        self._bands = _BandTables(bands)
+        self.bands = bands
+        self._digests = bytearray()
+
+    def __len__(self):
+        return len(self._digests) // 32
+
+    def get(self, row):
+        """returns the NilsimsaDigest appended as `row`"""
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        start = 32 * row
+        digest = bytes(self._digests[start:start + 32])
+        return NilsimsaDigest.from_bytes(digest)
+
+    def append(self, digest, is_hex=True):
+        """adds `digest` to the index and returns its row number"""
+        digest = as_nilsimsa_digest(digest, is_hex)
+        row = len(self)
+        self._digests += digest.to_bytes()
+        for table, band in zip(self._bands.tables, self._bands.values(digest)):
+            rows = table.get(band)
+            if rows is None:
+                rows = table[band] = array('i')
+            rows.append(row)
+        return row
+
+    def query(self, digest, threshold, is_hex=True):
+        """
+        returns a list of (row, score) for every stored digest whose
+        nilsimsa score against `digest` is >= `threshold`, highest score
+        first
+        """
+        digest = as_nilsimsa_digest(digest, is_hex)
+        return _verify(digest, self._bands.candidates(digest, threshold),
+                       self.get, threshold)
+
+
+class BKTree(object):
+    """
+    Burkhard-Keller tree of nilsimsa digests keyed by document id, see
+    the module docstring
+
+    After each query, `last_visited` holds the number of tree nodes whose
+    digest was compared against the query.
+    """
+    def __init__(self, items=None, is_hex=True):
+        # a node is [seq, key, value, {distance: child node}]
+        self._root = None
+        self._size = 0
+        self.last_visited = 0
+        if items is not None:
+            for key, digest in items:
+                self.insert(key, digest, is_hex=is_hex)
+
+    @classmethod
+    def from_digests(cls, digests, is_hex=True):
+        """
+        builds a tree from a list of digests, hex strings by default,
+        keyed by their position in the list
+        """
+        return cls(enumerate(digests), is_hex=is_hex)
+
+    def __len__(self):
+        return self._size
+
+    def insert(self, key, digest, is_hex=True):
+        """adds `digest` to the tree under document id `key`"""
+        value = int(as_nilsimsa_digest(digest, is_hex))
+        new = [self._size, key, value, {}]
+        self._size += 1
+        if self._root is None:
+            self._root = new
+            return
+        node = self._root
+        while True:
+            distance = popcount(value ^ node[2])
+            child = node[3].get(distance)
+            if child is None:
+                node[3][distance] = new
+                return
+            node = child
+
+    def query(self, digest, threshold, is_hex=True):
+        """
+        returns a list of (key, score) for every stored digest whose
+        nilsimsa score against `digest` is >= `threshold`, highest score
+        first and in insertion order among equal scores
+        """
+        value = int(as_nilsimsa_digest(digest, is_hex))
+        radius = 128 - threshold
+        found = []
+        visited = 0
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            visited += 1
+            distance = popcount(value ^ node[2])
+            if distance <= radius:
+                found.append((distance, node[0], node[1]))
+            for child_distance, child in node[3].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    stack.append(child)
+        self.last_visited = visited
+        found.sort()
+        return [(key, 128 - distance) for distance, seq, key in found]
+
+    def nearest(self, digest, k, is_hex=True):
+        """
+        returns a list of (key, score) for the `k` stored digests with the
+        highest nilsimsa score against `digest`, highest score first and
+        in insertion order among equal scores
+        """
+        value = int(as_nilsimsa_digest(digest, is_hex))
+        if k <= 0 or self._root is None:
+            self.last_visited = 0
+            return []
+        # best holds (-distance, -seq, key) for the k best seen so far, so
+        # best[0] is the worst of them
+        best = []
+        visited = 0
+        # search nodes in order of the lower bound on their distance
+        pending = [(0, self._root[0], self._root)]
+        while pending:
+            bound, seq, node = heapq.heappop(pending)
+            if len(best) == k and bound > -best[0][0]:
+                break
+            visited += 1
+            distance = popcount(value ^ node[2])
+            if len(best) < k:
+                heapq.heappush(best, (-distance, -node[0], node[1]))
+            elif (distance, node[0]) < (-best[0][0], -best[0][1]):
+                heapq.heapreplace(best, (-distance, -node[0], node[1]))
+            tau = -best[0][0] if len(best) == k else 256
+            for child_distance, child in node[3].items():
+                child_bound = abs(distance - child_distance)
+                if child_bound <= tau:
+                    heapq.heappush(pending, (child_bound, child[0], child))
+        self.last_visited = visited
+        best.sort(reverse=True)
+        return [(key, 128 + distance) for distance, seq, key in best]
+
+
+def _num_probes(width, radius):
+    """number of band values within `radius` bits of a `width` bit value"""
+    total = 0
+    count = 1
+    for k in range(min(radius, width) + 1):
+        total += count
+        count = count * (width - k) // (k + 1)
+    return total
+
+
+def _probes(value, width, radius):
+    """yields every `width` bit value within `radius` bits of `value`"""
+    yield value
+    bits = [1 << i for i in range(width)]
+    for k in range(1, min(radius, width) + 1):
+        for flipped in combinations(bits, k):
+            yield value ^ sum(flipped)
@@ -0,0 +1,121 @@
+"""
+Purpose: opt-in metrics for the nilsimsa hot paths.
+
+When enabled, Nilsimsa.process, Nilsimsa.compute_digest, compare_digests
+and nilsimsa.batch.compare_batch record how much work they did and how
+long it took: bytes hashed, chunks processed, digests computed,
+comparisons made, how many comparisons with a threshold bailed out
+below it, and cumulative seconds in each.  When disabled, which is the
+default, each of those calls only checks one module global.
+
+The counters are available as a plain dict from snapshot(), and an
+optional callback is called with (event, count, seconds) for every
+recorded event so they can be forwarded to other telemetry.  Counters
+are updated without locking, so totals from several threads are
+approximate.
+
+Usage:
+    from nilsimsa import metrics
+    metrics.enable()
+    ...
+    print(metrics.snapshot())
+    metrics.disable()
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+"""
+from __future__ import absolute_import
+
+import time
+
+import nilsimsa
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time   # Python 2
+
+
+class Metrics(object):
+    """counters for the nilsimsa hot paths, see the module docstring"""
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.clock = clock
+        self.reset()
+
+    def reset(self):
+        """sets every counter back to zero"""
+        self.bytes_hashed = 0
+        self.chunks_processed = 0
+        self.process_seconds = 0.0
+        self.digests_computed = 0
+        self.digest_seconds = 0.0
+        self.comparisons = 0
+        self.early_exits = 0
+        self.compare_seconds = 0.0
+
+    def record_process(self, nbytes, seconds):
+        self.bytes_hashed += nbytes
+        self.chunks_processed += 1
+        self.process_seconds += seconds
+        if self.callback is not None:
+            self.callback('process', nbytes, seconds)
+
+    def record_digest(self, seconds):
+        self.digests_computed += 1
+        self.digest_seconds += seconds
+        if self.callback is not None:
+            self.callback('digest', 1, seconds)
+
+    def record_compare(self, early_exits, seconds, count=1):
+        """
+        records `count` comparisons, `early_exits` of which (a bool for a
+        single comparison) scored below their threshold
+        """
+        self.comparisons += count
+        self.early_exits += int(early_exits)
+        self.compare_seconds += seconds
+        if self.callback is not None:
+            self.callback('compare', count, seconds)
+            if early_exits:
+                self.callback('early_exit', int(early_exits), 0.0)
+
+    def snapshot(self):
+        """returns the counters as a dict"""
+        return {
+            'bytes_hashed': self.bytes_hashed,
+            'chunks_processed': self.chunks_processed,
+            'process_seconds': self.process_seconds,
+            'digests_computed': self.digests_computed,
+            'digest_seconds': self.digest_seconds,
+            'comparisons': self.comparisons,
+            'early_exits': self.early_exits,
+            'early_exit_rate': (self.early_exits / float(self.comparisons)
+                                if self.comparisons else 0.0),
+            'compare_seconds': self.compare_seconds,
+        }
+
+
+def enable(callback=None):
+    """
+    starts recording metrics into a fresh Metrics object, which is
+    returned; `callback`, if given, is called as callback(event, count,
+    seconds) for every event, where event is one of 'process', 'digest',
+    'compare' or 'early_exit'
+    """
+    nilsimsa._metrics = Metrics(callback)
+    return nilsimsa._metrics
+
+
+def disable():
+    """stops recording metrics, returning the last snapshot or None"""
+    current = nilsimsa._metrics
+    nilsimsa._metrics = None
+    return current.snapshot() if current is not None else None
+
+
+def snapshot():
+    """returns the current counters as a dict, or None when disabled"""
+    current = nilsimsa._metrics
+    return current.snapshot() if current is not None else None
@@ -0,0 +1,139 @@
+"""
+Purpose: compute nilsimsa digests of many files in parallel.
+
+digest_files() shards a list of paths across a pool of worker
+processes, so hashing a large corpus uses every core.  Results stream
+back as they are produced, either in submission order or in completion
+order, and a failure to read or hash one file is reported for that file
+instead of aborting the whole run.
+
+digest_file_parallel() instead splits one large file into byte ranges,
+hashes the ranges on separate cores and combines the partial states
+with Nilsimsa.merge, giving exactly the digest of a sequential pass.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+"""
+from __future__ import absolute_import
+
+import itertools
+import multiprocessing
+import os
+
+from nilsimsa import CHUNK_SIZE, Nilsimsa
+
+
+def digest_file(path, backend=None):
+    """returns the nilsimsa hexdigest of the file at `path`"""
+    nil = Nilsimsa(backend=backend)
+    nil.from_file(path)
+    return nil.hexdigest()
+
+
+def _digest_file_task(task):
+    """worker entry point: returns (path, hexdigest, error)"""
+    path, backend, capture_errors = task
+    try:
+        return path, digest_file(path, backend=backend), None
+    except Exception as exc:
+        if not capture_errors:
+            raise
+        return path, None, exc
+
+
+def digest_files(paths, workers=None, chunksize=1, ordered=True,
+                 backend=None, capture_errors=True):
+    """
+    yields (path, hexdigest, error) for every path in `paths`, computed by
+    a pool of `workers` processes (default: one per cpu)
+
+    Paths are sent to the workers in batches of `chunksize`; larger
+    batches amortize the interprocess overhead for many small files.
+    With `ordered`, results come back in the order of `paths`, otherwise
+    as soon as each file is done.  If hashing a file raises, its result
+    has hexdigest None and the exception as error, unless
+    `capture_errors` is False, in which case the exception is re-raised.
+    With workers=1 the files are hashed in this process.
+    """
+    paths = iter(paths)
+    for first in paths:
+        break
+    else:
+        # nothing to hash, so do not start a pool
+        return
+    tasks = ((path, backend, capture_errors)
+             for path in itertools.chain([first], paths))
+    if workers == 1:
+        for task in tasks:
+            yield _digest_file_task(task)
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        if ordered:
+            results = pool.imap(_digest_file_task, tasks, chunksize)
+        else:
+            results = pool.imap_unordered(_digest_file_task, tasks, chunksize)
+        for result in results:
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def digest_range(path, start, end, backend=None, chunk_size=CHUNK_SIZE):
+    """
+    returns a Nilsimsa object fed bytes [start, end) of the file at
+    `path`, read chunk_size bytes at a time
+    """
+    nil = Nilsimsa(backend=backend)
+    f = open(path, "rb")
+    try:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            nil.process(chunk)
+            remaining -= len(chunk)
+    finally:
+        f.close()
+    return nil
+
+
+def _digest_range_task(task):
+    return digest_range(*task)
+
+
+def digest_file_parallel(path, workers=None, segment_size=None, backend=None):
+    """
+    returns a Nilsimsa object for the whole file at `path`, hashed as
+    independent byte ranges by a pool of `workers` processes (default:
+    one per cpu) and merged in order
+
+    The file is split into ranges of `segment_size` bytes, by default one
+    range per worker.
+    """
+    size = os.path.getsize(path)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if segment_size is None:
+        segment_size = max(1, -(-size // workers))
+    tasks = [(path, start, min(start + segment_size, size), backend)
+             for start in range(0, size, segment_size)]
+    if workers == 1 or len(tasks) <= 1:
+        parts = [_digest_range_task(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            parts = pool.map(_digest_range_task, tasks)
+        finally:
+            pool.terminate()
+            pool.join()
+    if not parts:
+        return Nilsimsa(backend=backend)
+    nil = parts[0]
+    for part in parts[1:]:
+        nil.merge(part)
+    return nil
@@ -0,0 +1,182 @@
+"""
+Purpose: nilsimsa digests of every sliding window over a stream.
+
+RollingNilsimsa yields the digest of each window of `window_size` bytes,
+one window every `step` bytes, without rehashing each window from
+scratch.  It keeps the accumulator of the trigrams of the characters in
+the current window, adding the trigrams of incoming characters and
+subtracting those of outgoing ones, so each step costs O(step).  The
+characters of a step are counted with the unrolled loop of the table
+backend or, for steps of at least NUMPY_MIN_CHUNK characters when numpy
+is installed, with a fixed number of array operations.
+
+A fresh Nilsimsa(window_bytes) does not form the trigrams that would
+reach back before the start of the window, so when a digest is emitted
+the trigrams of the first four characters of the window that refer to
+earlier characters are taken out.  The digests match a fresh Nilsimsa
+of the window bytes exactly.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+"""
+from __future__ import absolute_import
+
+from nilsimsa import (Nilsimsa, TRIGRAMS, byte_view, supports_buffer,
+                      text_type)
+from nilsimsa import _auto_backend
+from nilsimsa._table_backend import X, Y, Z
+
+# the trigrams (a, b, c, n, reach) of the k'th character of a window,
+# for k < 4, that reach back before the start of the window
+CROSSING = [[(a, b, c, n, max(a, b, c)) for (a, b, c, n) in TRIGRAMS
+             if max(a, b, c) > k]
+            for k in range(4)]
+
+# chunks are copied into the window buffer this many bytes at a time, so
+# a large buffer or mmap passed to update() is never copied whole
+BLOCK_SIZE = 1 << 16
+
+
+class RollingNilsimsa(object):
+    """
+    rolling nilsimsa hasher, see the module docstring
+
+    Feed chunks with update(), which yields (offset, hexdigest) for each
+    window completed by the chunk, where offset is the position of the
+    first byte of the window in the stream.
+    """
+    def __init__(self, window_size, step=1):
+        if window_size < 1 or step < 1:
+            raise ValueError("Expected window_size >= 1 and step >= 1, got "
+                             "{} and {}".format(window_size, step))
+        self.window_size = window_size
+        self.step = step
+        self.acc = [0] * 256
+        self.start = 0          # offset of the current window
+        self.count = 0          # number of bytes seen
+        self._added = 0         # acc holds the characters before this offset
+        self._buf = bytearray()
+        self._base = 0          # offset of self._buf[0]
+
+    def _buckets(self, i):
+        """
+        returns the accumulator buckets of the trigrams of the character at
+        offset i, which has fewer than eight near the start of the stream
+        """
+        buf = self._buf
+        base = self._base
+        return [((X[n][buf[i - a - base]] ^ Y[n][buf[i - b - base]])
+                 + Z[n][buf[i - c - base]]) & 255
+                for (a, b, c, n) in TRIGRAMS
+                if max(a, b, c) <= i]
+
+    def _count(self, lo, hi, sign):
+        """
+        adds `sign` times the trigrams of the characters at offsets lo to
+        hi - 1, each formed with the characters before it, to the
+        accumulator
+        """
+        acc = self.acc
+        # the first four characters of the stream have fewer trigrams
+        while lo < min(hi, 4):
+            for bucket in self._buckets(lo):
+                acc[bucket] += sign
+            lo += 1
+        if lo >= hi:
+            return
+        base = self._base
+        if hi - lo >= _auto_backend.NUMPY_MIN_CHUNK:
+            backend = _auto_backend._numpy_backend
+            if backend is False:
+                backend = _auto_backend._load_numpy_backend()
+            if backend is not None:
+                counts = backend.history_counts(
+                    bytes(self._buf[lo - 4 - base:hi - base]))
+                for i, count in enumerate(counts.tolist()):
+                    acc[i] += sign * count
+                return
+        # the loop of _table_backend.process, over the buffered window
+        X0, X1, X2, X3, X4, X5, X6, X7 = X
+        Y0, Y1, Y2, Y3, Y4, Y5, Y6, Y7 = Y
+        Z0, Z1, Z2, Z3, Z4, Z5, Z6, Z7 = Z
+        counts = [0] * 512
+        w3, w2, w1, w0 = self._buf[lo - 4 - base:lo - base]
+        for c in self._buf[lo - base:hi - base]:
+            counts[(X0[c] ^ Y0[w0]) + Z0[w1]] += 1
+            counts[(X1[c] ^ Y1[w0]) + Z1[w2]] += 1
+            counts[(X2[c] ^ Y2[w1]) + Z2[w2]] += 1
+            counts[(X3[c] ^ Y3[w0]) + Z3[w3]] += 1
+            counts[(X4[c] ^ Y4[w1]) + Z4[w3]] += 1
+            counts[(X5[c] ^ Y5[w2]) + Z5[w3]] += 1
+            counts[(X6[w3] ^ Y6[w0]) + Z6[c]] += 1
+            counts[(X7[w3] ^ Y7[w2]) + Z7[c]] += 1
+            w3 = w2
+            w2 = w1
+            w1 = w0
+            w0 = c
+        for i in range(256):
+            acc[i] += sign * (counts[i] + counts[i + 256])
+
+    def _hexdigest(self):
+        acc = list(self.acc)
+        buf = self._buf
+        start = self.start
+        # drop the trigrams reaching back before the start of the window
+        for k in range(min(4, self.window_size)):
+            i = start + k - self._base
+            for (a, b, c, n, reach) in CROSSING[k]:
+                if reach <= start + k:
+                    acc[((X[n][buf[i - a]] ^ Y[n][buf[i - b]])
+                         + Z[n][buf[i - c]]) & 255] -= 1
+        nil = Nilsimsa()
+        nil.acc = acc
+        nil.num_char = self.window_size
+        return nil.hexdigest()
+
+    def update(self, chunk):
+        """
+        adds the bytes of `chunk` to the stream, yielding (offset,
+        hexdigest) for each window completed
+        """
+        if isinstance(chunk, text_type):
+            chunk = chunk.encode('utf-8')
+        view = byte_view(chunk)
+        for offset in range(0, len(view), BLOCK_SIZE):
+            block = view[offset:offset + BLOCK_SIZE]
+            self._buf += block
+            self.count += len(block)
+            end = self.start + self.window_size
+            while end <= self.count:
+                # when step > window_size the bytes in the gap between
+                # windows are never added
+                self._count(max(self._added, self.start), end, 1)
+                self._added = end
+                yield self.start, self._hexdigest()
+                self._count(self.start, min(self.start + self.step, end), -1)
+                self.start += self.step
+                end = self.start + self.window_size
+            self._trim()
+
+    def _trim(self):
+        # keep the four characters before the window for its trigrams; when
+        # step > window_size the window may start past the bytes seen, so
+        # only drop what is buffered and _base stays the offset of _buf[0]
+        drop = min(self.start - 4, self.count) - self._base
+        if drop > max(4096, len(self._buf) // 2):
+            del self._buf[:drop]
+            self._base += drop
+
+
+def rolling_digests(data, window_size, step=1):
+    """
+    yields (offset, hexdigest) for every window of `window_size` bytes
+    starting at a multiple of `step`, where data is a string or an
+    iterator over chunks as accepted by Nilsimsa
+    """
+    rolling = RollingNilsimsa(window_size, step)
+    if isinstance(data, (bytes, text_type)) or supports_buffer(data):
+        data = [data]
+    for chunk in data:
+        for result in rolling.update(chunk):
+            yield result
@@ -0,0 +1,150 @@
+"""
+Purpose: multi-threaded search over a packed digest matrix.
+
+compare_digests is pure Python and holds the GIL, so threads calling it
+take turns.  ShardedSearch instead splits an N x 32 packed digest matrix
+into contiguous shards of rows and scores each shard with the numpy xor
+and popcount kernels of nilsimsa.batch, which release the GIL while they
+run.  A thread pool scans the shards concurrently and the per-shard
+results are merged in row order, so a query over a large corpus is
+spread across cores without copying the matrix into other processes.
+Many query threads can share one ShardedSearch.
+
+Shards are views of the matrix, not copies, so a DigestStore can be
+searched straight from its map; make a new ShardedSearch to see records
+appended after it was created.
+
+This module requires numpy.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+"""
+from __future__ import absolute_import
+
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import nilsimsa
+from nilsimsa.batch import as_packed, as_query, bit_differences, top_k
+
+# shards are never smaller than this many rows, since below that the
+# cost of handing a shard to a thread outweighs scoring it
+MIN_SHARD_SIZE = 1 << 14
+
+
+class ShardedSearch(object):
+    """
+    searches `digests`, a packed digest matrix or buffer, any iterable
+    accepted by nilsimsa.batch.as_packed(), or a DigestStore, with a pool
+    of `workers` threads (default: one per cpu)
+
+    The rows are split into shards of `shard_size` rows, by default one
+    shard per worker.  Use as a context manager, or call close(), to shut
+    down the pool.
+    """
+    def __init__(self, digests, workers=None, shard_size=None):
+        self.packed = as_packed(getattr(digests, 'digests', digests))
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if shard_size is None:
+            shard_size = max(MIN_SHARD_SIZE, -(-len(self.packed) // workers))
+        self.workers = workers
+        self.shard_size = shard_size
+        self.shards = [(start, self.packed[start:start + shard_size])
+                       for start in range(0, len(self.packed), shard_size)]
+        self._executor = None
+        if workers > 1 and len(self.shards) > 1:
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """shuts down the thread pool"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _map(self, func, *args):
+        """returns [func(start, shard, *args)] for every shard, in order"""
+        if self._executor is None:
+            return [func(start, shard, *args) for start, shard in self.shards]
+        futures = [self._executor.submit(func, start, shard, *args)
+                   for start, shard in self.shards]
+        return [future.result() for future in futures]
+
+    def compare(self, digest, is_hex=True, threshold=None):
+        """
+        returns an array of the nilsimsa scores between `digest` and every
+        row, the same as nilsimsa.batch.compare_batch
+        """
+        metrics = nilsimsa._metrics
+        if metrics is not None:
+            start = metrics.clock()
+        query = as_query(digest, is_hex=is_hex)
+        scores = np.empty(len(self.packed), dtype=np.int64)
+        # each shard writes its own slice of `scores`, so there is nothing
+        # left to merge
+        self._map(_score_shard, query, scores)
+        below = 0
+        if threshold is not None:
+            below_threshold = scores < threshold
+            scores[below_threshold] = threshold - 1
+            below = int(below_threshold.sum()) if metrics is not None else 0
+        if metrics is not None:
+            metrics.record_compare(below, metrics.clock() - start,
+                                   count=len(scores))
+        return scores
+
+    def query(self, digest, threshold, is_hex=True):
+        """
+        returns a list of (index, score) for every row whose nilsimsa
+        score against `digest` is >= `threshold`, highest score first and
+        lowest index first among equal scores
+        """
+        query = as_query(digest, is_hex=is_hex)
+        found = self._map(_match_shard, query, threshold)
+        rows = np.concatenate([rows for rows, scores in found] +
+                              [np.zeros(0, dtype=np.int64)])
+        scores = np.concatenate([scores for rows, scores in found] +
+                                [np.zeros(0, dtype=np.int64)])
+        # rows are increasing, so a stable sort keeps ties in row order
+        order = np.argsort(-scores, kind='stable')
+        return list(zip(rows[order].tolist(), scores[order].tolist()))
+
+    def top_k(self, digest, k, is_hex=True):
+        """
+        returns a list of (index, score) for the `k` rows with the highest
+        nilsimsa score against `digest`, highest score first and lowest
+        index first among equal scores, see nilsimsa.batch.top_k
+        """
+        query = as_query(digest, is_hex=is_hex)
+        best = []
+        for shard_best in self._map(_top_k_shard, query, k):
+            best.extend(shard_best)
+        best.sort(key=lambda result: (-result[1], result[0]))
+        return best[:k]
+
+
+def _score_shard(start, shard, query, scores):
+    scores[start:start + len(shard)] = 128 - bit_differences(query, shard)
+
+
+def _match_shard(start, shard, query, threshold):
+    scores = 128 - bit_differences(query, shard)
+    rows = np.flatnonzero(scores >= threshold)
+    return rows + start, scores[rows]
+
+
+def _top_k_shard(start, shard, query, k):
+    return [(start + row, score)
+            for row, score in top_k(query, shard, k, is_hex=False)]
@@ -0,0 +1,421 @@
+"""
+Purpose: digest index in shared memory, built once and searched by many
+worker processes without each loading its own copy.
+
+A loader process publishes the corpus with SharedIndexWriter.  Each
+publish() writes a complete new generation into its own shared memory
+segment: the packed N x 32 digest matrix, and for each of BANDS 16-bit
+bands of the digest, the band values of every row in sorted order with
+the matching row numbers, followed by the document ids.  Only once the
+generation is fully written is its number stored in a small control
+segment, under a sequence counter that readers check, so a reader
+either sees the previous generation or the new one and never a
+half-written one.  The segment of the previous generation is then
+unlinked; readers still attached to it keep a valid mapping until they
+move on.
+
+Workers open a SharedDigestIndex by name.  It maps the current
+generation read-only, with every array a numpy view of the shared
+segment rather than a copy, and refresh() switches to a newer
+generation when one has been published.  Queries with a high threshold
+look up candidates in the sorted band arrays (by pigeonhole, a digest
+within d bits of the query agrees to within d // BANDS bits on some
+band, see nilsimsa.index); others scan the packed matrix with the
+vectorized kernels of nilsimsa.batch.
+
+Segment names must be valid shared memory names, short enough for the
+platform (31 characters on macOS).  Requires Python 3.8 and numpy.
+
+Before Python 3.13, SharedMemory has no track=False, so readers attach
+by briefly replacing multiprocessing.resource_tracker.register with a
+no-op under a module lock.  The writer takes the same lock while it
+creates segments, so a reader attaching in another thread of the
+writer's process cannot leave a new segment unregistered.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+"""
+from __future__ import absolute_import
+
+import struct
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from nilsimsa.batch import as_packed, as_query, bit_differences, top_k
+from nilsimsa.index import _num_probes, _probes
+
+MAGIC = b'NILSHMIX'
+VERSION = 1
+BANDS = 16
+
+# magic, version, sequence (odd while a generation is being published),
+# current generation
+CONTROL = struct.Struct('<8sIxxxxQQ')
+SEQUENCE = struct.Struct('<Q')
+SEQUENCE_AT = 16
+GENERATION_AT = 24
+
+# magic, version, bands, count, size of the document ids blob, padded so
+# the digest records start 64 byte aligned
+HEADER = struct.Struct('<8sIIQQ32x')
+
+# queries probing band values more than this many bits from the query's
+# scan the whole matrix instead
+MAX_PROBE_RADIUS = 2
+
+
+def _segment_name(name, generation):
+    return '%s-%d' % (name, generation)
+
+
+_untracked = threading.Lock()
+
+def _attach(name):
+    """
+    opens an existing segment without registering it with this process's
+    resource tracker, which would otherwise unlink it when the process
+    exits, out from under the loader and the other workers
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    # unregistering after the fact is not an option, since the tracker
+    # may be shared with the writer, e.g. in forked workers
+    with _untracked:
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def _create(name, size):
+    """
+    creates a new segment registered with the resource tracker, holding
+    the lock _attach() takes while the tracker is bypassed
+    """
+    with _untracked:
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+
+
+def _view(buf, dtype, shape, offset):
+    """
+    returns an array of `shape` over buf at `offset`; unlike
+    np.ndarray(buffer=...), frombuffer keeps buf exported for as long as
+    the array lives, so the segment cannot be unmapped under it
+    """
+    count = int(np.prod(shape))
+    return np.frombuffer(buf, dtype, count, offset).reshape(shape)
+
+
+def _layout(count, ids_size):
+    """
+    returns the offsets of the digests, band values, band rows, id
+    offsets and ids blob in a segment, and its total size
+    """
+    digests = HEADER.size
+    band_values = digests + count * 32
+    band_rows = band_values + BANDS * count * 2
+    id_offsets = band_rows + BANDS * count * 4
+    ids = id_offsets + (count + 1) * 8
+    return digests, band_values, band_rows, id_offsets, ids, ids + ids_size
+
+
+def band_values(packed):
+    """returns the N x BANDS uint16 band values of a packed digest matrix"""
+    return packed.view('>u2').astype(np.uint16)
+
+
+class SharedIndexWriter(object):
+    """
+    owner of the shared digest index `name`, see the module docstring
+
+    Creates the control segment, which must not already exist.  close()
+    unlinks the control segment and the current generation, after which
+    readers can no longer attach; use as a context manager to do so
+    automatically.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.generation = 0
+        self._sequence = 0
+        self._segment = None
+        self._control = _create(name, CONTROL.size)
+        CONTROL.pack_into(self._control.buf, 0, MAGIC, VERSION, 0, 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def publish(self, digests, doc_ids=None):
+        """
+        writes `digests` as a new generation and makes it current,
+        returning its generation number
+
+        `digests` is a packed digest matrix or buffer, an iterable
+        accepted by nilsimsa.batch.as_packed(), or a DigestStore, whose
+        document ids are used unless `doc_ids` is given.  Document ids
+        default to the row numbers.
+        """
+        if doc_ids is None and hasattr(digests, 'doc_ids'):
+            doc_ids = digests.doc_ids()
+        packed = as_packed(getattr(digests, 'digests', digests))
+        count = len(packed)
+        if doc_ids is None:
+            doc_ids = range(count)
+        encoded = [(u'%s' % (doc_id,)).encode('utf-8') for doc_id in doc_ids]
+        if len(encoded) != count:
+            raise ValueError("Expected {} document ids, got {}"
+                             .format(count, len(encoded)))
+        ids = b''.join(encoded)
+        offsets = _layout(count, len(ids))
+
+        generation = self.generation + 1
+        segment = _create(_segment_name(self.name, generation),
+                          max(1, offsets[-1]))
+        try:
+            _write_generation(segment.buf, packed, encoded, ids, offsets)
+        except Exception:
+            segment.close()
+            segment.unlink()
+            raise
+
+        # a seqlock: readers retry while the sequence is odd or changes
+        # under them, so they never see a torn generation number
+        buf = self._control.buf
+        self._sequence += 1
+        SEQUENCE.pack_into(buf, SEQUENCE_AT, self._sequence)
+        SEQUENCE.pack_into(buf, GENERATION_AT, generation)
+        self._sequence += 1
+        SEQUENCE.pack_into(buf, SEQUENCE_AT, self._sequence)
+        self.generation = generation
+
+        previous, self._segment = self._segment, segment
+        if previous is not None:
+            previous.close()
+            previous.unlink()
+        return generation
+
+    def close(self):
+        """unlinks the control segment and the current generation"""
+        if self._segment is not None:
+            self._segment.close()
+            self._segment.unlink()
+            self._segment = None
+        if self._control is not None:
+            self._control.close()
+            self._control.unlink()
+            self._control = None
+
+
+def _write_generation(buf, packed, encoded, ids, offsets):
+    digests_at, values_at, rows_at, id_offsets_at, ids_at, end = offsets
+    count = len(packed)
+    HEADER.pack_into(buf, 0, MAGIC, VERSION, BANDS, count, len(ids))
+    _view(buf, np.uint8, (count, 32), digests_at)[:] = packed
+    values = _view(buf, np.uint16, (BANDS, count), values_at)
+    rows = _view(buf, np.uint32, (BANDS, count), rows_at)
+    for band, column in enumerate(band_values(packed).T):
+        order = np.argsort(column, kind='stable')
+        values[band] = column[order]
+        rows[band] = order
+    id_offsets = _view(buf, np.uint64, (count + 1,), id_offsets_at)
+    id_offsets[0] = 0
+    np.cumsum([len(doc_id) for doc_id in encoded], out=id_offsets[1:])
+    buf[ids_at:end] = ids
+
+
+class SharedDigestIndex(object):
+    """
+    read-only view of the current generation of the shared digest index
+    `name`, see the module docstring
+
+    `digests` is the N x 32 packed digest matrix of the generation,
+    `generation` its number.  Raises FileNotFoundError if no writer has
+    created the index.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.generation = None
+        self._segment = None
+        self._retired = []
+        self._control = _attach(name)
+        magic, version, sequence, generation = CONTROL.unpack_from(
+            self._control.buf)
+        if magic != MAGIC:
+            raise ValueError("{} is not a shared nilsimsa index".format(name))
+        if version != VERSION:
+            raise ValueError("Unsupported shared index version {}"
+                             .format(version))
+        self.refresh()
+
+    def _current_generation(self):
+        """reads the published generation number, waiting out a publish"""
+        buf = self._control.buf
+        while True:
+            before, = SEQUENCE.unpack_from(buf, SEQUENCE_AT)
+            generation, = SEQUENCE.unpack_from(buf, GENERATION_AT)
+            after, = SEQUENCE.unpack_from(buf, SEQUENCE_AT)
+            if before == after and not before & 1:
+                return generation
+            time.sleep(0)
+
+    def refresh(self):
+        """
+        switches to the newest published generation, returning whether it
+        changed; arrays taken from the old generation remain valid
+        """
+        while True:
+            generation = self._current_generation()
+            if generation == self.generation:
+                return False
+            if generation == 0:
+                raise ValueError("Nothing has been published to {}"
+                                 .format(self.name))
+            try:
+                segment = _attach(_segment_name(self.name, generation))
+            except FileNotFoundError:
+                # superseded and unlinked before we got to it; try again
+                continue
+            break
+        self._map(segment)
+        self.generation = generation
+        return True
+
+    def _map(self, segment):
+        buf = segment.buf
+        magic, version, bands, count, ids_size = HEADER.unpack_from(buf)
+        if magic != MAGIC or bands != BANDS:
+            raise ValueError("{} is not a shared nilsimsa index generation"
+                             .format(segment.name))
+        digests_at, values_at, rows_at, id_offsets_at, ids_at, end = \
+            _layout(count, ids_size)
+        digests = _view(buf, np.uint8, (count, 32), digests_at)
+        values = _view(buf, np.uint16, (BANDS, count), values_at)
+        rows = _view(buf, np.uint32, (BANDS, count), rows_at)
+        id_offsets = _view(buf, np.uint64, (count + 1,), id_offsets_at)
+        for array in (digests, values, rows, id_offsets):
+            array.flags.writeable = False
+        self._release()
+        self._segment = segment
+        self.digests = digests
+        self._band_values = values
+        self._band_rows = rows
+        self._id_offsets = id_offsets
+        self._ids = buf[ids_at:end].toreadonly()
+
+    def _release(self):
+        if self._segment is not None:
+            self._ids.release()
+            self.digests = self._band_values = self._band_rows = None
+            self._id_offsets = self._ids = None
+            self._retired.append(self._segment)
+            self._segment = None
+        retired = []
+        for segment in self._retired:
+            try:
+                segment.close()
+            except BufferError:
+                # arrays handed out from `digests` still reference it, so
+                # keep it to close later
+                retired.append(segment)
+        self._retired = retired
+
+    def __len__(self):
+        return len(self.digests)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """detaches from the index; the writer owns and unlinks it"""
+        self._release()
+        if self._control is not None:
+            try:
+                self._control.close()
+            except BufferError:
+                pass
+            self._control = None
+
+    def doc_id(self, i):
+        """returns the document id of row i"""
+        if not 0 <= i < len(self.digests):
+            raise IndexError(i)
+        start, end = self._id_offsets[i:i + 2].tolist()
+        return bytes(self._ids[start:end]).decode('utf-8')
+
+    def compare(self, digest, is_hex=True, threshold=None):
+        """
+        returns an array of the nilsimsa scores between `digest` and every
+        row, see nilsimsa.batch.compare_batch
+        """
+        scores = 128 - bit_differences(as_query(digest, is_hex=is_hex),
+                                       self.digests)
+        if threshold is not None:
+            scores[scores < threshold] = threshold - 1
+        return scores
+
+    def candidates(self, digest, threshold, is_hex=True):
+        """
+        returns a sorted array of the rows that may score >= `threshold`
+        against `digest`, found in the band tables, or None if the probe
+        radius is too large and every row is a candidate
+        """
+        max_bits = 128 - threshold
+        if max_bits < 0:
+            return np.zeros(0, dtype=np.int64)
+        radius = max_bits // BANDS
+        if radius > MAX_PROBE_RADIUS or \
+                _num_probes(16, radius) * BANDS > len(self.digests):
+            return None
+        query = as_query(digest, is_hex=is_hex)
+        found = []
+        for band, value in enumerate(band_values(query[None, :])[0].tolist()):
+            probes = np.array(sorted(_probes(value, 16, radius)),
+                              dtype=np.uint16)
+            values = self._band_values[band]
+            starts = np.searchsorted(values, probes, side='left')
+            ends = np.searchsorted(values, probes, side='right')
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                if start < end:
+                    found.append(self._band_rows[band][start:end])
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(found)).astype(np.int64)
+
+    def query(self, digest, threshold, is_hex=True):
+        """
+        returns a list of (row, score) for every row whose nilsimsa score
+        against `digest` is >= `threshold`, highest score first and lowest
+        row first among equal scores
+        """
+        query = as_query(digest, is_hex=is_hex)
+        rows = self.candidates(query, threshold, is_hex=False)
+        if rows is None:
+            scores = 128 - bit_differences(query, self.digests)
+            rows = np.flatnonzero(scores >= threshold)
+            scores = scores[rows]
+        else:
+            scores = 128 - bit_differences(query, self.digests[rows])
+            match = scores >= threshold
+            rows, scores = rows[match], scores[match]
+        # rows are increasing, so a stable sort keeps ties in row order
+        order = np.argsort(-scores, kind='stable')
+        return list(zip(rows[order].tolist(), scores[order].tolist()))
+
+    def top_k(self, digest, k, is_hex=True):
+        """
+        returns a list of (row, score) for the `k` rows with the highest
+        nilsimsa score against `digest`, see nilsimsa.batch.top_k
+        """
+        return top_k(digest, self.digests, k, is_hex=is_hex)
@@ -0,0 +1,205 @@
+"""
+Purpose: compact on-disk store of nilsimsa digests, opened with mmap.
+
+A store is a binary file holding a 64 byte header followed by one fixed
+32 byte record per digest, in the byte order of Nilsimsa.digest, plus a
+sidecar file (the store path with ".ids" appended) holding the matching
+document ids one per line.  The record count is derived from the file
+size, so appending never rewrites the header.
+
+Readers map the records with mmap, so processes opening the same store
+share the same page cache pages, and batch comparisons run directly
+against the mapped buffer with no copy.
+
+This software is released under an MIT/X11 open source license.
+
+Copyright 2012-2015 Diffeo, Inc.
+"""
+from __future__ import absolute_import
+
+import io
+import mmap
+import os
+import struct
+
+from nilsimsa import NilsimsaDigest, as_nilsimsa_digest
+
+MAGIC = b'NILSIMSA'
+VERSION = 1
+RECORD_SIZE = 32
+
+# magic, version, record size, padded so records start 64 byte aligned
+HEADER = struct.Struct('<8sII48x')
+
+
+class DigestStore(object):
+    """
+    digest store at `path`, see the module docstring
+
+    mode 'r' opens an existing store read-only; mode 'a' opens it for
+    appending, creating it if it does not exist and first dropping any
+    record left incomplete by an interrupted append.  Records appended after
+    the store was opened become visible to readers after refresh().
+    """
+    def __init__(self, path, mode='r'):
+        if mode not in ('r', 'a'):
+            raise ValueError("Expected mode 'r' or 'a', got {!r}".format(mode))
+        self.path = path
+        self.ids_path = path + '.ids'
+        self.mode = mode
+        self._map = None
+        self._ids = None
+        self._writer = None
+        self._ids_writer = None
+        if mode == 'a':
+            if not os.path.exists(path):
+                with open(path, 'wb') as f:
+                    f.write(HEADER.pack(MAGIC, VERSION, RECORD_SIZE))
+                open(self.ids_path, 'wb').close()
+            else:
+                self._drop_partial()
+            self._writer = open(path, 'ab')
+            self._ids_writer = io.open(self.ids_path, 'a', encoding='utf-8',
+                                       newline='\n')
+        self.refresh()
+
+    def refresh(self):
+        """remaps the store to pick up records appended since it was opened"""
+        with open(self.path, 'rb') as f:
+            magic, version, record_size = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or record_size != RECORD_SIZE:
+                raise ValueError("{} is not a nilsimsa digest store"
+                                 .format(self.path))
+            if version != VERSION:
+                raise ValueError("Unsupported digest store version {}"
+                                 .format(version))
+            new_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # the old map is not closed here since arrays handed out by
+        # `digests` may still reference it; it is released with them
+        self._map = new_map
+        # ignore a partially written trailing record
+        self._count = (len(new_map) - HEADER.size) // RECORD_SIZE
+        self._ids = None
+
+    def _drop_partial(self):
+        """
+        truncates a partially written trailing record, and any record
+        or document id missing its counterpart, left by an interrupted
+        append, so that new records are appended at a record boundary
+        """
+        self.refresh()
+        self._map.close()
+        self._map = None
+        count = ids_size = 0
+        with open(self.ids_path, 'rb') as f:
+            for line in f:
+                if count == self._count or not line.endswith(b'\n'):
+                    break
+                count += 1
+                ids_size += len(line)
+        for path, size in [(self.path, HEADER.size + count * RECORD_SIZE),
+                           (self.ids_path, ids_size)]:
+            if os.path.getsize(path) != size:
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+
+    def __len__(self):
+        return self._count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """closes the map and any open writers"""
+        if self._writer is not None:
+            self._writer.close()
+            self._ids_writer.close()
+            self._writer = self._ids_writer = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # still exported through `digests` or `buffer`
+                pass
+            self._map = None
+
+    def append(self, doc_id, digest, is_hex=True):
+        """
+        appends one digest with its document id, which must not contain
+        a newline; takes param for format, default is hex string but can
+        accept list of 32 ints or a NilsimsaDigest
+        """
+        if self._writer is None:
+            raise IOError("DigestStore {} is not open for appending"
+                          .format(self.path))
+        doc_id = u'%s' % (doc_id,)
+        if u'\n' in doc_id:
+            raise ValueError("Document ids must not contain newlines")
+        self._writer.write(as_nilsimsa_digest(digest, is_hex).to_bytes())
+        self._ids_writer.write(doc_id + u'\n')
+
+    def extend(self, items, is_hex=True):
+        """appends (doc_id, digest) pairs, see append()"""
+        for doc_id, digest in items:
+            self.append(doc_id, digest, is_hex=is_hex)
+
+    def flush(self):
+        """flushes appended records to disk and makes them visible here"""
+        if self._writer is not None:
+            self._writer.flush()
+            self._ids_writer.flush()
+        self.refresh()
+
+    @property
+    def buffer(self):
+        """memoryview of the packed records, without copying them"""
+        view = memoryview(self._map)
+        return view[HEADER.size:HEADER.size + self._count * RECORD_SIZE]
+
+    @property
+    def digests(self):
+        """
+        the records as a read-only N x 32 numpy uint8 array backed by the
+        map; requires numpy
+        """
+        import numpy as np
+        return np.frombuffer(self._map, dtype=np.uint8,
+                             count=self._count * RECORD_SIZE,
+                             offset=HEADER.size).reshape(-1, RECORD_SIZE)
+
+    def digest(self, i):
+        """returns the i'th digest as a NilsimsaDigest"""
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        start = HEADER.size + i * RECORD_SIZE
+        return NilsimsaDigest.from_bytes(self._map[start:start + RECORD_SIZE])
+
+    def doc_ids(self):
+        """returns the list of document ids, in record order"""
+        if self._ids is None:
+            with io.open(self.ids_path, encoding='utf-8', newline='\n') as f:
+                ids = f.read().split(u'\n')
+            self._ids = ids[:self._count]
+        return self._ids
+
+    def compare(self, digest, is_hex=True, threshold=None):
+        """
+        returns an array of the nilsimsa scores between `digest` and every
+        record, computed against the mapped records; requires numpy, see
+        nilsimsa.batch.compare_batch
+        """
+        from nilsimsa.batch import compare_batch
+        return compare_batch(digest, self.digests, is_hex=is_hex,
+                             threshold=threshold)
+
+    def top_k(self, digest, k, is_hex=True):
+        """
+        returns a list of (record index, score) for the `k` records with
+        the highest nilsimsa score against `digest`, computed against the
+        mapped records; requires numpy, see nilsimsa.batch.top_k
+        """
+        from nilsimsa.batch import top_k
+        return top_k(digest, self.digests, k, is_hex=is_hex)
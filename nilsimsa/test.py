@@ -17,13 +17,15 @@ try:
     from dircache import listdir
 except ImportError:
     from os import listdir   # dircache gone in Python 3
+import io
+import json
 import os
 import pytest
 import random
-import time
+import sys
 
 from nilsimsa.deprecated._deprecated_nilsimsa import Nilsimsa as orig_Nilsimsa
-from nilsimsa import Nilsimsa, compare_digests, convert_hex_to_ints
+from nilsimsa import Nilsimsa, NilsimsaDigest, compare_digests, convert_hex_to_ints
 
 test_data_dir = os.path.join(os.path.dirname(__file__), "test_data/")
 test_data = "test_dict.p"
@@ -36,27 +38,132 @@ def test_nilsimsa():
     computes the nilsimsa digest and compares to the true
     value stored in the pickled sid_to_nil dictionary
     """
-    fname = random.choice(listdir(test_data_dir))
+    fname = random.choice([n for n in listdir(test_data_dir) if n.endswith('.txt')])
     f = open(os.path.join(test_data_dir, fname), "rb")
     nil = Nilsimsa(f.read())
     f.close()
     assert nil.hexdigest() == sid_to_nil[fname.split(".")[0]]
 
-def test_nilsimsa_speed():
+def test_benchmark(tmpdir, monkeypatch):
     """
-    computes nilsimsa hash for all test files and prints speed
+    checks regression detection on synthetic results, that main() writes
+    JSON results and fails against a faster baseline, and smoke tests
+    one benchmark
     """
-    corpus = []
+    from nilsimsa import bench
+    results = {'results': {'a': 100.0, 'b': 50.0, 'new': 1.0}}
+    baseline = {'results': {'a': 110.0, 'b': 100.0, 'gone': 5.0}}
+    assert bench.regressions(results, baseline, 0.2) == [('b', 50.0, 100.0)]
+    assert bench.regressions(results, baseline, 0.6) == []
+    assert bench.regressions(results, results, 0.0) == []
+    monkeypatch.setattr(bench, 'run', lambda quick: results)
+    output = str(tmpdir.join('bench.json'))
+    assert bench.main(['--quick', '--output', output]) == 0
+    with open(output) as f:
+        assert json.load(f) == results
+    baseline_path = str(tmpdir.join('baseline.json'))
+    with open(baseline_path, 'w') as f:
+        json.dump(baseline, f)
+    assert bench.main(['--baseline', baseline_path]) == 1
+    digests = sorted(sid_to_nil.values())[:3]
+    rates = bench.bench_compare(digests, min_time=0)
+    assert all(rate > 0 for rate in rates.values())
+    # without the deprecated implementation, as when installed
+    monkeypatch.setattr(bench, 'available_backends', lambda: ['table'])
+    monkeypatch.setitem(sys.modules,
+                        'nilsimsa.deprecated._deprecated_nilsimsa', None)
+    rates = bench.bench_digests([b'abcdefgh'], {'small': 1 << 12}, min_time=0)
+    assert list(rates) == ['digest.table.small.MBps']
+
+def test_numpy_backend():
+    """
+    checks that the numpy backend gives the stored hexdigest for every
+    test file, both whole and fed in small chunks
+    """
+    pytest.importorskip('numpy')
     for fname in listdir(test_data_dir):
+        if not fname.endswith('.txt'):
+            continue
+        f = open(os.path.join(test_data_dir, fname), "rb")
+        text = f.read()
+        f.close()
+        expected = sid_to_nil[fname.split(".")[0]]
+        assert Nilsimsa(text, backend='numpy').hexdigest() == expected
+        chunks = [text[i:i+1001] for i in range(0, len(text), 1001)]
+        assert Nilsimsa(chunks, backend='numpy').hexdigest() == expected
+
+@pytest.mark.parametrize('backend', ['table', 'numpy', 'auto'])
+def test_backend_short_inputs(backend):
+    """
+    checks that the faster backends carry the window across chunk
+    boundaries for inputs shorter than a full window
+    """
+    if backend == 'numpy':
+        pytest.importorskip('numpy')
+    for text in [b'a', b'ab', b'abc', b'abcd', b'abcde', b'abcdefgh']:
+        for size in range(1, 4):
+            chunks = [text[i:i+size] for i in range(0, len(text), size)]
+            nil = Nilsimsa(chunks, backend=backend)
+            ref = Nilsimsa(chunks, backend='python')
+            assert nil.acc == ref.acc
+            assert nil.window == ref.window
+            assert nil.num_char == ref.num_char
+
+def test_table_backend():
+    """
+    checks that the table backend matches the reference implementation
+    bit for bit on a few randomly selected test files
+    """
+    names = [n for n in listdir(test_data_dir) if n.endswith('.txt')]
+    for fname in set(random.choice(names) for i in range(3)):
         f = open(os.path.join(test_data_dir, fname), "rb")
-        corpus.append(f.read())
+        text = f.read()
         f.close()
-    start = time.time()
-    for text in corpus:
-        Nilsimsa(text)
-    elapsed = time.time() - start
-    print("%d in %f --> %f per second" % (
-        len(corpus), elapsed, len(corpus)/elapsed))
+        nil = Nilsimsa(text, backend='table')
+        assert nil.acc == Nilsimsa(text, backend='python').acc
+        assert nil.hexdigest() == sid_to_nil[fname.split(".")[0]]
+
+def test_unknown_backend():
+    """
+    ensures that an unknown backend name is rejected
+    """
+    with pytest.raises(ValueError):
+        Nilsimsa(b'abcd', backend='nope')
+    with pytest.raises(ValueError):
+        compare_digests('0' * 64, '0' * 64, backend='nope')
+
+def test_backend_registry(monkeypatch):
+    """
+    checks the default backend and its environment override, that
+    registered backends are only imported when used, and that the
+    compare backends agree with the reference comparison
+    """
+    import nilsimsa
+    assert Nilsimsa().backend == 'auto'
+    monkeypatch.setenv('NILSIMSA_BACKEND', 'table')
+    assert Nilsimsa().backend == 'table'
+    monkeypatch.setattr(nilsimsa, 'BACKENDS', dict(nilsimsa.BACKENDS))
+    nilsimsa.register_backend('missing', 'nilsimsa._no_such_backend')
+    assert 'missing' not in nilsimsa.available_backends()
+    assert 'table' in nilsimsa.available_backends()
+    with pytest.raises(ImportError):
+        Nilsimsa(backend='missing')
+    sid_1 = "1352396387-81c1161097f9f00914e1b152ca4c0f46"
+    sid_2 = "1338103128-006193af403dcc90c962184df08960a3"
+    for threshold in (None, 0, 110):
+        expected = compare_digests(sid_to_nil[sid_1], sid_to_nil[sid_2],
+                                   threshold=threshold, backend='python')
+        score = compare_digests(sid_to_nil[sid_1], sid_to_nil[sid_2],
+                                threshold=threshold, backend='auto')
+        if threshold is None or expected >= threshold:
+            assert score == expected
+        else:
+            assert score == threshold - 1
+    # the reference early exit stops a whole byte past the threshold
+    monkeypatch.setenv('NILSIMSA_BACKEND', 'python')
+    assert compare_digests('0' * 64, 'f' * 64, threshold=127) == 120
+    monkeypatch.delenv('NILSIMSA_BACKEND')
+    assert compare_digests('0' * 64, 'f' * 64, threshold=127) == 126
 
 def test_unicode():
     """
@@ -114,3 +221,655 @@ def test_compatability():
         if not(Nilsimsa(text).hexdigest() == orig_Nilsimsa(text).hexdigest()):
             assert False
     assert True
+
+def test_compare_batch():
+    """
+    tests compare_batch against compare_digests for every pair of
+    digests in the test corpus, with and without a threshold
+    """
+    pytest.importorskip('numpy')
+    from nilsimsa.batch import compare_batch, pack_digests
+    digests = list(sid_to_nil.values())
+    packed = pack_digests(digests)
+    for digest in digests:
+        scores = compare_batch(digest, packed)
+        assert list(scores) == [compare_digests(digest, d) for d in digests]
+        scores = compare_batch(digest, packed.tobytes(), threshold=110)
+        assert list(scores) == [max(compare_digests(digest, d), 109)
+                                for d in digests]
+
+def test_hex_bulk(tmpdir):
+    """
+    tests decoding hex digest lines and files into packed arrays, with
+    bad lines reported, and encoding them back
+    """
+    pytest.importorskip('numpy')
+    from nilsimsa.batch import (decode_hex, encode_hex, pack_digests,
+                                read_hex, unpack_digests)
+    digests = [digest for sid, digest in sorted(sid_to_nil.items())]
+    packed = pack_digests(digests)
+    assert [bytes(row) for row in packed] == \
+        [NilsimsaDigest.from_hex(d).to_bytes() for d in digests]
+    assert unpack_digests(packed) == digests
+    lines = [digests[0] + '\tdoc 0\n', digests[1].upper(), 'not hex', '',
+             digests[2][:-1] + 'g', digests[3][:63], digests[4] + ' x',
+             digests[5].encode('ascii') + b'\r\n']
+    decoded, bad = decode_hex(lines)
+    assert bad == [2, 3, 4, 5, 6]
+    assert unpack_digests(decoded) == [digests[0], digests[1], digests[5]]
+    path = str(tmpdir.join('digests.tsv'))
+    with open(path, 'wb') as f:
+        f.write(b''.join(line if isinstance(line, bytes) else
+                         (line.rstrip('\n') + '\n').encode('ascii')
+                         for line in lines))
+    for block_size in [10, 100, 1 << 20]:
+        with open(path, 'rb') as f:
+            from_file, bad = read_hex(f, block_size=block_size)
+        assert bad == [2, 3, 4, 5, 6]
+        assert (from_file == decoded).all()
+    assert read_hex(path)[1] == [2, 3, 4, 5, 6]
+    assert read_hex(io.BytesIO(encode_hex(packed)))[0].tolist() == \
+        packed.tolist()
+    with pytest.raises(ValueError):
+        pack_digests(['abc'])
+
+def test_nilsimsa_digest():
+    """
+    tests that NilsimsaDigest round-trips through hex, bytes, ints and
+    pickle, and scores the same as compare_digests on hex strings
+    """
+    sid_1 = "1352396387-81c1161097f9f00914e1b152ca4c0f46"
+    sid_2 = "1338103128-006193af403dcc90c962184df08960a3"
+    digest_1 = NilsimsaDigest.from_hex(sid_to_nil[sid_1])
+    digest_2 = NilsimsaDigest.from_hex(sid_to_nil[sid_2])
+    assert digest_1.hexdigest() == sid_to_nil[sid_1]
+    assert digest_1.to_ints() == convert_hex_to_ints(sid_to_nil[sid_1])
+    assert NilsimsaDigest.from_bytes(digest_1.to_bytes()) == digest_1
+    assert pickle.loads(pickle.dumps(digest_1)) == digest_1
+    assert len(set([digest_1, NilsimsaDigest(int(digest_1)), digest_2])) == 2
+    assert compare_digests(digest_1, digest_2) == 95
+    assert compare_digests(digest_1, sid_to_nil[sid_2]) == 95
+    assert compare_digests(digest_1, digest_2, threshold=110) == 109
+    with pytest.raises(AttributeError):
+        digest_1._value = 0
+
+def test_compare_nilsimsa_digest():
+    """
+    tests that Nilsimsa.compare accepts a NilsimsaDigest directly
+    """
+    nil_1 = Nilsimsa(b'The quick brown fox jumps over the lazy dog')
+    nil_2 = Nilsimsa(b'The quick brown fox jumped over the lazy dog')
+    assert nil_1.compare(nil_2.compact_digest()) == nil_1.compare(nil_2.digest)
+    assert nil_1.compact_digest().hexdigest() == nil_1.hexdigest()
+
+def test_self_join():
+    """
+    tests that self_join finds exactly the pairs that nested
+    compare_digests calls find, across several tiles and with threads
+    """
+    pytest.importorskip('numpy')
+    from nilsimsa.batch import self_join
+    digests = list(sid_to_nil.values())
+    expected = []
+    for i in range(len(digests)):
+        for j in range(i + 1, len(digests)):
+            score = compare_digests(digests[i], digests[j])
+            if score >= 20:
+                expected.append((i, j, score))
+    assert sorted(self_join(digests, 20, block_size=6)) == expected
+    assert sorted(self_join(digests, 20, block_size=6, workers=3)) == expected
+
+def test_nilsimsa_index():
+    """
+    tests that NilsimsaIndex returns exactly the digests a full scan
+    finds, for exact-match and probing band configurations, and that
+    deleted digests are no longer returned
+    """
+    from nilsimsa.index import NilsimsaIndex, bands_for_threshold
+    digests = sorted(sid_to_nil.items())
+    for bands in [4, 16, bands_for_threshold(60)]:
+        index = NilsimsaIndex(bands)
+        for sid, digest in digests:
+            index.insert(sid, digest)
+        for sid, digest in digests:
+            expected = set((other, compare_digests(digest, other_digest))
+                           for other, other_digest in digests
+                           if compare_digests(digest, other_digest) >= 60)
+            assert set(index.query(digest, 60)) == expected
+    sid, digest = digests[0]
+    index.delete(sid)
+    assert sid not in index
+    assert sid not in [key for key, score in index.query(digest, 60)]
+
+def test_bktree():
+    """
+    tests that BKTree range and top-k queries agree with a full scan,
+    including the ordering of equal scores
+    """
+    from nilsimsa.index import BKTree
+    digests = [digest for sid, digest in sorted(sid_to_nil.items())]
+    digests += digests[:3]
+    tree = BKTree.from_digests(digests)
+    assert len(tree) == len(digests)
+    for query in digests:
+        ranked = sorted((-compare_digests(query, digest), i)
+                        for i, digest in enumerate(digests))
+        expected = [(i, -score) for score, i in ranked]
+        assert tree.query(query, 60) == [(i, score) for i, score in expected
+                                         if score >= 60]
+        assert tree.nearest(query, 5) == expected[:5]
+        assert 0 < tree.last_visited <= len(digests)
+
+def test_digest_store(tmpdir):
+    """
+    tests appending to a DigestStore, reopening it read-only and
+    comparing against the mapped records
+    """
+    from nilsimsa.store import DigestStore
+    path = str(tmpdir.join('digests.bin'))
+    items = sorted(sid_to_nil.items())
+    with DigestStore(path, mode='a') as store:
+        store.extend(items[:10])
+        store.flush()
+        assert len(store) == 10
+        store.extend(items[10:])
+    with DigestStore(path) as store:
+        assert len(store) == len(items)
+        assert store.doc_ids() == [sid for sid, digest in items]
+        assert store.digest(3).hexdigest() == items[3][1]
+        assert bytes(store.buffer[:32]) == store.digest(0).to_bytes()
+        pytest.importorskip('numpy')
+        query = items[0][1]
+        scores = store.compare(query, threshold=50)
+        assert list(scores) == [max(compare_digests(query, digest), 49)
+                                for sid, digest in items]
+    # a torn record and a missing id are dropped before appending again
+    with open(path, 'ab') as f:
+        f.write(b'\xff' * 10)
+    with open(path + '.ids', 'ab') as f:
+        f.write(b'partial')
+    with DigestStore(path, mode='a') as store:
+        assert len(store) == len(items)
+        store.extend(items[:2])
+    with open(path, 'ab') as f:
+        f.write(items[2][1][:32].encode('ascii'))
+    with DigestStore(path, mode='a') as store:
+        assert len(store) == len(items) + 2
+        store.append('last', items[3][1])
+    with DigestStore(path) as store:
+        assert len(store) == len(items) + 3
+        assert store.doc_ids() == ([sid for sid, digest in items + items[:2]]
+                                   + ['last'])
+        assert store.digest(len(items) + 1).hexdigest() == items[1][1]
+        assert store.digest(len(items) + 2).hexdigest() == items[3][1]
+
+def test_top_k(tmpdir):
+    """
+    tests that top_k matches a full sort over hex lists, NilsimsaDigests,
+    packed matrices and a DigestStore, keeping ties in index order
+    """
+    from nilsimsa import top_k
+    digests = [digest for sid, digest in sorted(sid_to_nil.items())]
+    # repeat the corpus so there are ties
+    digests = digests * 3
+    query = digests[4]
+    ranked = sorted(range(len(digests)),
+                    key=lambda i: (-compare_digests(query, digests[i]), i))
+    for k in [0, 1, 5, len(digests) + 1]:
+        expected = [(i, compare_digests(query, digests[i])) for i in ranked[:k]]
+        assert top_k(query, digests, k) == expected
+        compact = [NilsimsaDigest.from_hex(digest) for digest in digests]
+        assert top_k(query, compact, k) == expected
+    pytest.importorskip('numpy')
+    from nilsimsa.batch import pack_digests, top_k as batch_top_k
+    from nilsimsa.store import DigestStore
+    packed = pack_digests(digests)
+    path = str(tmpdir.join('digests.bin'))
+    with DigestStore(path, mode='a') as store:
+        store.extend(enumerate(digests))
+        store.flush()
+        for k in [0, 1, 5, len(digests) + 1]:
+            expected = [(i, compare_digests(query, digests[i]))
+                        for i in ranked[:k]]
+            assert batch_top_k(query, packed, k, block_size=7) == expected
+            assert top_k(query, packed.tobytes(), k) == expected
+            assert top_k(query, store, k) == expected
+            assert store.top_k(query, k) == expected
+
+def test_sharded_search():
+    """
+    tests that a ShardedSearch over several threads gives the same scores,
+    range query and top-k results as scanning the whole matrix
+    """
+    pytest.importorskip('numpy')
+    from nilsimsa import top_k
+    from nilsimsa.batch import compare_batch, pack_digests
+    from nilsimsa.search import ShardedSearch
+    digests = [digest for sid, digest in sorted(sid_to_nil.items())] * 3
+    packed = pack_digests(digests)
+    query = digests[4]
+    scores = compare_batch(query, packed)
+    expected = [(i, score) for i, score in top_k(query, digests, len(digests))
+                if score >= 70]
+    for workers in [1, 3]:
+        with ShardedSearch(packed, workers=workers, shard_size=7) as search:
+            assert len(search.shards) == 9
+            assert list(search.compare(query)) == list(scores)
+            assert (list(search.compare(query, threshold=70)) ==
+                    list(compare_batch(query, packed, threshold=70)))
+            assert search.query(query, 70) == expected
+            assert search.top_k(query, 5) == top_k(query, digests, 5)
+
+def test_shared_index():
+    """
+    tests publishing generations of a shared memory index and querying
+    them from a reader, including one in another process
+    """
+    pytest.importorskip('numpy')
+    pytest.importorskip('multiprocessing.shared_memory')
+    import multiprocessing
+    from nilsimsa.batch import compare_batch, pack_digests
+    from nilsimsa.shared import SharedDigestIndex, SharedIndexWriter
+    items = sorted(sid_to_nil.items())
+    packed = pack_digests([digest for sid, digest in items] * 2)
+    doc_ids = [sid for sid, digest in items] * 2
+    query = items[4][1]
+    scores = compare_batch(query, packed).tolist()
+    name = 'nilsimsa-test-%d' % os.getpid()
+    with SharedIndexWriter(name) as writer:
+        assert writer.publish(packed, doc_ids) == 1
+        with SharedDigestIndex(name) as index:
+            assert index.generation == 1
+            assert len(index) == len(packed)
+            assert not index.digests.flags.writeable
+            assert index.doc_id(3) == items[3][0]
+            for threshold in [128, 110, 60]:
+                expected = sorted(
+                    [(i, score) for i, score in enumerate(scores)
+                     if score >= threshold], key=lambda r: (-r[1], r[0]))
+                assert index.query(query, threshold) == expected
+            assert index.top_k(query, 2) == [(4, 128), (4 + len(items), 128)]
+            pool = multiprocessing.get_context('spawn').Pool(1)
+            try:
+                assert pool.apply(_shared_index_query, (name, query)) == \
+                    (1, items[4][0], index.top_k(query, 3))
+            finally:
+                pool.terminate()
+                pool.join()
+            old = index.digests
+            assert not index.refresh()
+            writer.publish(packed[:5])
+            assert index.refresh()
+            assert index.generation == 2
+            assert len(index) == 5
+            assert index.doc_id(4) == '4'
+            # arrays from the superseded generation stay readable
+            assert len(old) == len(packed)
+            assert bytes(old[4]) == bytes(packed[4])
+            del old
+
+def _shared_index_query(name, query):
+    from nilsimsa.shared import SharedDigestIndex
+    with SharedDigestIndex(name) as index:
+        return (index.generation, index.doc_id(4), index.top_k(query, 3))
+
+def test_digest_files():
+    """
+    tests that digest_files hashes every test file in a process pool,
+    ordered and unordered, and captures per-file errors
+    """
+    from nilsimsa.parallel import digest_files
+    fnames = sorted(n for n in listdir(test_data_dir) if n.endswith('.txt'))
+    paths = [os.path.join(test_data_dir, fname) for fname in fnames]
+    missing = os.path.join(test_data_dir, 'missing.txt')
+    expected = [sid_to_nil[fname.split(".")[0]] for fname in fnames]
+    results = list(digest_files(paths + [missing], workers=2, chunksize=3,
+                                backend='table'))
+    assert [path for path, digest, error in results] == paths + [missing]
+    assert [digest for path, digest, error in results[:-1]] == expected
+    assert results[-1][1] is None
+    assert isinstance(results[-1][2], IOError)
+    results = digest_files(paths, workers=2, ordered=False, backend='table')
+    assert sorted(digest for path, digest, error in results) == sorted(expected)
+
+def test_from_file():
+    """
+    tests that from_file gives the stored digest when reading in small
+    chunks, with and without mmap, and that from_stream matches it
+    """
+    fname = sorted(n for n in listdir(test_data_dir) if n.endswith('.txt'))[0]
+    path = os.path.join(test_data_dir, fname)
+    expected = sid_to_nil[fname.split(".")[0]]
+    for use_mmap in [False, True]:
+        nil = Nilsimsa(backend='table').from_file(path, chunk_size=4099,
+                                                  use_mmap=use_mmap)
+        assert nil.hexdigest() == expected
+    f = open(path, "rb")
+    assert Nilsimsa(backend='table').from_stream(f, 1000).hexdigest() == expected
+    f.close()
+
+@pytest.mark.parametrize('backend', ['python', 'table', 'numpy'])
+def test_buffer_input(backend):
+    """
+    tests that objects supporting the buffer protocol, whole or in
+    chunks, hash to the same digest as the equivalent bytes
+    """
+    if backend == 'numpy':
+        pytest.importorskip('numpy')
+    import array
+    import mmap
+    fname = sorted(n for n in listdir(test_data_dir) if n.endswith('.txt'))[0]
+    with open(os.path.join(test_data_dir, fname), "rb") as f:
+        text = f.read()
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    expected = sid_to_nil[fname.split(".")[0]]
+    view = memoryview(text)
+    inputs = [bytearray(text), view, mapped, array.array('B', text),
+              [view[:3], bytearray(text[3:1000]), text[1000:]]]
+    for data in inputs:
+        assert Nilsimsa(data, backend=backend).hexdigest() == expected
+    mapped.close()
+    # multi-byte items hash as their raw bytes; strided views are copied
+    words = array.array('I', text[:len(text) // 4 * 4])
+    assert (Nilsimsa(words, backend=backend).hexdigest() ==
+            Nilsimsa(words.tobytes(), backend=backend).hexdigest())
+    assert (Nilsimsa(view[::3], backend=backend).hexdigest() ==
+            Nilsimsa(text[::3], backend=backend).hexdigest())
+    with pytest.raises(TypeError):
+        Nilsimsa(12345, backend=backend)
+
+def test_digest_stream():
+    """
+    tests that digest_stream gives the stored digest when reading from
+    an asyncio.StreamReader and from an async iterator
+    """
+    import asyncio
+    from nilsimsa.aio import digest_stream
+    fname = sorted(n for n in listdir(test_data_dir) if n.endswith('.txt'))[1]
+    f = open(os.path.join(test_data_dir, fname), "rb")
+    text = f.read()
+    f.close()
+    expected = sid_to_nil[fname.split(".")[0]]
+
+    async def from_reader():
+        reader = asyncio.StreamReader()
+        reader.feed_data(text)
+        reader.feed_eof()
+        return await digest_stream(reader, chunk_size=5000, backend='table')
+
+    async def chunks():
+        for i in range(0, len(text), 3000):
+            yield text[i:i+3000]
+
+    async def from_iterator():
+        return await digest_stream(chunks(), backend='table',
+                                   offload_threshold=None)
+
+    assert asyncio.run(from_reader()).hexdigest() == expected
+    assert asyncio.run(from_iterator()).hexdigest() == expected
+
+def test_merge():
+    """
+    tests that merging the states of consecutive segments, including
+    segments shorter than the window, matches a sequential pass
+    """
+    text = b'The quick brown fox jumps over the lazy dog'
+    for cuts in [[1], [2, 3], [4, 20], [3, 4, 5, 30], [10, 11, 12, 13]]:
+        bounds = [0] + cuts + [len(text)]
+        nil = Nilsimsa(text[:bounds[1]])
+        for start, end in zip(bounds[1:], bounds[2:]):
+            nil.merge(Nilsimsa(text[start:end]))
+        expected = Nilsimsa(text)
+        assert nil.acc == expected.acc
+        assert nil.window == expected.window
+        assert nil.hexdigest() == expected.hexdigest()
+
+def test_digest_file_parallel():
+    """
+    tests that hashing one file as merged parallel segments gives the
+    stored digest
+    """
+    from nilsimsa.parallel import digest_file_parallel
+    fname = sorted(n for n in listdir(test_data_dir) if n.endswith('.txt'))[2]
+    path = os.path.join(test_data_dir, fname)
+    nil = digest_file_parallel(path, workers=3, segment_size=10007,
+                               backend='table')
+    assert nil.hexdigest() == sid_to_nil[fname.split(".")[0]]
+
+def test_rolling_digests(monkeypatch):
+    """
+    tests that every rolling window digest matches a fresh Nilsimsa of
+    the window bytes, for overlapping and non-overlapping windows, with
+    and without numpy
+    """
+    from nilsimsa import _auto_backend, rolling
+    from nilsimsa.rolling import rolling_digests
+    fname = sorted(n for n in listdir(test_data_dir) if n.endswith('.txt'))[3]
+    f = open(os.path.join(test_data_dir, fname), "rb")
+    text = f.read()[:3000]
+    f.close()
+    chunks = [text[i:i+101] for i in range(0, len(text), 101)]
+    cases = [(3, 1), (64, 16), (500, 123), (20, 50), (900, 300)]
+    for window_size, step in cases:
+        expected = [(start, Nilsimsa(text[start:start + window_size]).hexdigest())
+                    for start in range(0, len(text) - window_size + 1, step)]
+        assert list(rolling_digests(chunks, window_size, step)) == expected
+        with monkeypatch.context() as patch:
+            patch.setattr(_auto_backend, '_numpy_backend', None)
+            patch.setattr(rolling, 'BLOCK_SIZE', 700)
+            assert list(rolling_digests(text, window_size, step)) == expected
+    # steps far beyond the window, so whole chunks fall between windows
+    rng = random.Random(13)
+    data = bytes(bytearray(rng.getrandbits(8) for i in range(12000)))
+    for window_size, step in [(10, 4200), (50, 4300)]:
+        expected = [(start, Nilsimsa(data[start:start + window_size]).hexdigest())
+                    for start in range(0, len(data) - window_size + 1, step)]
+        chunks = [data[i:i+1000] for i in range(0, len(data), 1000)]
+        assert list(rolling_digests(chunks, window_size, step)) == expected
+        assert list(rolling_digests(data, window_size, step)) == expected
+        assert list(rolling_digests(bytearray(data), window_size, step)) == expected
+        assert list(rolling_digests(memoryview(data), window_size, step)) == expected
+
+def test_chunk_digests():
+    """
+    tests that content-defined chunks cover the input, digest to the
+    same as a fresh Nilsimsa of their bytes, do not depend on how the
+    input is split, and resynchronize after an insertion
+    """
+    from nilsimsa.chunking import chunk_digests, matching_fraction
+    fname = sorted(n for n in listdir(test_data_dir) if n.endswith('.txt'))[0]
+    f = open(os.path.join(test_data_dir, fname), "rb")
+    text = f.read()
+    f.close()
+    chunks = list(chunk_digests(text, avg_size=1024, backend='table'))
+    assert sum(length for offset, length, digest in chunks) == len(text)
+    for offset, length, digest in chunks:
+        assert Nilsimsa(text[offset:offset + length]).hexdigest() == digest
+        assert length <= 4096
+    pieces = [text[i:i+333] for i in range(0, len(text), 333)]
+    assert list(chunk_digests(pieces, avg_size=1024)) == chunks
+    assert list(chunk_digests(bytearray(text), avg_size=1024)) == chunks
+    assert list(chunk_digests([memoryview(text)[:500], bytearray(text[500:])],
+                              avg_size=1024)) == chunks
+    shifted = list(chunk_digests(b'inserted at the start ' + text, 1024))
+    assert set(c[2] for c in chunks[1:]) <= set(c[2] for c in shifted)
+    assert matching_fraction(chunks, shifted, 100) == 1.0
+
+def test_digest_cache(tmpdir):
+    """
+    tests DigestCache hits, misses and LRU eviction, and that the
+    on-disk tier survives reopening
+    """
+    from nilsimsa.cache import DigestCache
+    path = str(tmpdir.join('cache'))
+    texts = [b'first document text', b'second document text',
+             b'third document text']
+    cache = DigestCache(max_entries=2, path=path, backend='table')
+    for text in texts + texts[2:]:
+        assert cache.hexdigest(text) == Nilsimsa(text).hexdigest()
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions']) == (1, 3, 1)
+    assert len(cache) == 2
+    cache.close()
+    with DigestCache(max_entries=2, path=path) as cache:
+        assert cache.lookup(texts[0]) == Nilsimsa(texts[0]).hexdigest()
+        assert cache.stats()['disk_hits'] == 1
+        assert cache.lookup(b'never seen') is None
+
+def test_metrics():
+    """
+    tests that enabled metrics count hashing, digests, comparisons and
+    threshold early exits, but not top-k pruning, and are passed to the
+    callback
+    """
+    from nilsimsa import metrics
+    events = []
+    metrics.enable(callback=lambda event, count, seconds: events.append(event))
+    try:
+        nil = Nilsimsa([b'first chunk ', u'second chunk'])
+        nil.hexdigest()
+        sid_1 = "1352396387-81c1161097f9f00914e1b152ca4c0f46"
+        sid_2 = "1338103128-006193af403dcc90c962184df08960a3"
+        compare_digests(sid_to_nil[sid_1], sid_to_nil[sid_2])
+        compare_digests(sid_to_nil[sid_1], sid_to_nil[sid_2], threshold=110)
+        stats = metrics.snapshot()
+    finally:
+        final = metrics.disable()
+    assert stats['bytes_hashed'] == 24
+    assert stats['chunks_processed'] == 2
+    assert stats['digests_computed'] == 1
+    assert stats['comparisons'] == 2
+    assert stats['early_exits'] == 1
+    assert stats['early_exit_rate'] == 0.5
+    assert final == stats
+    assert events == ['process', 'process', 'digest', 'compare', 'compare',
+                      'early_exit']
+    assert metrics.snapshot() is None
+    # merging does not count the boundary bytes a second time
+    first, second = Nilsimsa(b'first chunk '), Nilsimsa(b'second chunk')
+    metrics.enable()
+    try:
+        first.merge(second)
+        stats = metrics.snapshot()
+    finally:
+        metrics.disable()
+    assert stats['bytes_hashed'] == 0
+    assert stats['chunks_processed'] == 0
+    assert first.hexdigest() == Nilsimsa(b'first chunk second chunk').hexdigest()
+    # top-k pruning counts comparisons but not early exits
+    pytest.importorskip('numpy')
+    from nilsimsa.batch import top_k
+    digests = sorted(sid_to_nil.values())
+    metrics.enable()
+    try:
+        top_k(digests[0], digests, 1, block_size=2)
+        stats = metrics.snapshot()
+    finally:
+        metrics.disable()
+    assert stats['comparisons'] == len(digests)
+    assert stats['early_exits'] == 0
+
+def test_cli(tmpdir, monkeypatch, capsys):
+    """
+    tests the nilsimsa command: hashing a directory to TSV, then
+    searching the resulting digest file, and rejecting bad digests and
+    input lines
+    """
+    import io
+    from nilsimsa.cli import main
+    out = io.StringIO()
+    assert main(['hash', '-w', '2', '-b', 'table', test_data_dir], out=out) == 0
+    lines = out.getvalue().splitlines()
+    digests = dict((os.path.basename(path).split(".")[0], digest)
+                   for digest, path in (line.split('\t') for line in lines))
+    for sid, digest in sid_to_nil.items():
+        assert digests[sid] == digest
+    digest_file = str(tmpdir.join('digests.tsv'))
+    with open(digest_file, 'w') as f:
+        f.write(out.getvalue())
+    sid = "1352396387-81c1161097f9f00914e1b152ca4c0f46"
+    out = io.StringIO()
+    assert main(['search', '-d', digest_file, '-k', '1', '-f', 'ndjson',
+                 sid_to_nil[sid]], out=out) == 0
+    match = json.loads(out.getvalue())
+    assert match['score'] == 128
+    assert sid in match['match']
+    out = io.StringIO()
+    assert main(['compare', sid_to_nil[sid], sid_to_nil[sid]], out=out) == 0
+    assert out.getvalue() == '128\n'
+    assert main(['compare', 'abc', sid_to_nil[sid]], out=out) == 1
+    assert main(['search', '-d', digest_file, 'g' * 64], out=out) == 1
+    assert 'nilsimsa: abc: ' in capsys.readouterr().err
+    # malformed NDJSON lines are reported and skipped
+    with open(digest_file, 'a') as f:
+        f.write('{broken\n')
+    monkeypatch.setattr('sys.stdin', io.StringIO(
+        u'{broken\n{"digest": "%s", "path": "q"}\n' % sid_to_nil[sid]))
+    out = io.StringIO()
+    assert main(['search', '-d', digest_file, '-k', '1', '-'], out=out) == 1
+    assert out.getvalue().startswith('q\t')
+    err = capsys.readouterr().err
+    assert 'nilsimsa: %s:%d: ' % (digest_file, len(lines) + 1) in err
+    assert 'nilsimsa: -:1: ' in err
+    # hashing only stdin starts no worker pool
+    import multiprocessing
+    monkeypatch.setattr(multiprocessing, 'Pool', None)
+    monkeypatch.setattr('sys.stdin', io.TextIOWrapper(io.BytesIO(b'abcdef')))
+    out = io.StringIO()
+    assert main(['hash', '-'], out=out) == 0
+    assert out.getvalue() == Nilsimsa(b'abcdef').hexdigest() + '\t-\n'
+
+def test_clustering():
+    """
+    tests that incremental clustering and clustering of scored pairs give
+    the connected components found by brute force
+    """
+    from nilsimsa.cluster import IncrementalClusterer, UnionFind, cluster_pairs
+    digests = [digest for sid, digest in sorted(sid_to_nil.items())]
+    pairs = [(i, j, compare_digests(digests[i], digests[j]))
+             for i in range(len(digests)) for j in range(i + 1, len(digests))]
+    pairs = [pair for pair in pairs if pair[2] >= 100]
+    # brute force components by repeated relabelling
+    labels = list(range(len(digests)))
+    changed = True
+    while changed:
+        changed = False
+        for i, j, score in pairs:
+            low = min(labels[i], labels[j])
+            if labels[i] != low or labels[j] != low:
+                labels[i] = labels[j] = low
+                changed = True
+    expected = {}
+    for i, label in enumerate(labels):
+        expected.setdefault(label, []).append(i)
+    expected = dict((k, v) for k, v in expected.items() if len(v) > 1)
+    assert expected
+    assert cluster_pairs(pairs).clusters() == expected
+    clusterer = IncrementalClusterer(100)
+    for i, digest in enumerate(digests):
+        element, root = clusterer.add(digest)
+        assert element == i
+        assert root == clusterer.representative(i)
+    assert clusterer.clusters() == expected
+    from nilsimsa.index import NilsimsaIndex, PackedIndex
+    clusterer = IncrementalClusterer(100, index=NilsimsaIndex(29))
+    for digest in digests:
+        clusterer.add(digest)
+    assert clusterer.clusters() == expected
+    assert list(cluster_pairs(pairs, len(digests)).labels()) == labels
+    assert len(cluster_pairs(pairs).clusters(min_size=1)) == len(set(labels))
+    packed, index = PackedIndex(), NilsimsaIndex()
+    for i, digest in enumerate(digests):
+        assert packed.append(digest) == i
+        index.insert(i, digest)
+    assert packed.get(3).hexdigest() == digests[3]
+    for digest in digests:
+        for threshold in [120, 100, 70]:
+            assert (packed.query(digest, threshold) ==
+                    index.query(digest, threshold))
+    with pytest.raises(IndexError):
+        packed.get(len(digests))
+    assert not hasattr(packed, 'delete')
+    union_find = UnionFind(3)
+    assert union_find.union(2, 1) == 1
+    assert union_find.find(2) == 1
@@ -25,8 +25,13 @@ Python port of nilsimsa.  "A nilsimsa code is something like a hash, but unlike
       license="X/MIT http://opensource.org/licenses/MIT",
       zip_safe=False,
       install_requires=[],
+      extras_require={
+          'numpy': ['numpy'],
+      },
       entry_points="""
       # -*- Entry points: -*-
+      [console_scripts]
+      nilsimsa = nilsimsa.cli:main
       """,
       packages=['nilsimsa'],
       package_data = {"nilsimsa": ["test_data/*.txt", "test_data/*.p"]}